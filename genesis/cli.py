@@ -7,8 +7,12 @@ from shutil import rmtree
 from genesis import __description__
 from genesis.config import Config
 from genesis.deploy import DeployStrategy
+from genesis.deployment.cache import BuildCache
 from genesis.deployment.dispatcher import DeployDispatcher
+from genesis.deployment.executor import CommandExecutor
+from genesis.deployment.pipeline import DeployPipeline
 from genesis.parser import YamlParser
+from genesis.platforms.cache import PlatformCheckCache
 from genesis.utils import fail
 
 
@@ -43,7 +47,52 @@ def cli_main(base_dir=None):
                         action='store_true', default=False)
     parser.add_argument('--disable-platform-check', help='Disable platform verification',
                         action='store_true', default=False)
+    parser.add_argument('--platform-check-timeout',
+                        help='Seconds every platform gets to pass verification. Defaults to 30', type=int, default=30)
+    parser.add_argument('--platform-check-ttl',
+                        help='Seconds a successful platform verification is trusted for, by later runs. '
+                             'Defaults to 900, 0 disables caching', type=int, default=900)
+    parser.add_argument('--platform-check-cache', help='Platform verification cache file',
+                        default='~/.genesis/platform-checks.json')
+    parser.add_argument('--parse-workers', help='Number of processes used to expand the teams. Defaults to 1 (serial)',
+                        type=int, default=1)
     parser.add_argument('--batch-deploys', help='Number to batch VM deploys to per step', type=int, default=9999)
+    parser.add_argument('--pipeline-depth',
+                        help='Number of deployment steps to overlap (eg: cloning the next step while configuring '
+                             'the current one). At most 2, defaults to 1 (no pipelining)', type=int, default=1)
+    parser.add_argument('--terraform-format', help='Syntax of the generated terraform files. Defaults to hcl',
+                        choices=['hcl', 'json'], default='hcl')
+    parser.add_argument('--terraform-compact',
+                        help='Generate one terraform resource per host (using for_each over the teams), '
+                             'instead of one per host per team', action='store_true', default=False)
+    parser.add_argument('--build-cache',
+                        help='Build cache file, used to skip steps that are unchanged since their last successful run. '
+                             'Only use it when redeploying onto the same infrastructure, as skipped steps are not '
+                             'checked against it. Disabled by default')
+    parser.add_argument('--ansible-workers',
+                        help='Number of teams to run ansible for at once, each in their own ansible-playbook process. '
+                             'Defaults to 1 (one ansible-playbook process for every team)', type=int, default=1)
+    parser.add_argument('--ansible-inventory',
+                        help='Format of the generated ansible inventory. "yaml" writes the variables to group_vars and '
+                             'host_vars instead of inline. Defaults to ini', choices=['ini', 'yaml'], default='ini')
+    parser.add_argument('--execute-workers',
+                        help='Maximum number of commands a deployment step runs at once. Defaults to 0 (no limit)',
+                        type=int, default=0)
+    parser.add_argument('--command-timeout',
+                        help='Seconds a command may run before it is terminated. Defaults to 0 (no timeout)',
+                        type=int, default=0)
+    parser.add_argument('--fail-fast',
+                        help='Terminate the other commands of a deployment step as soon as one fails',
+                        action='store_true', default=False)
+    parser.add_argument('--retries',
+                        help='Number of times to retry ansible for the hosts that failed, or were unreachable. '
+                             'Defaults to 2', type=int, default=2)
+    parser.add_argument('--retry-backoff',
+                        help='Seconds to wait before the first retry, doubled on every retry. Defaults to 30',
+                        type=int, default=30)
+    parser.add_argument('--retry-failed',
+                        help='Only run ansible for the hosts that failed during the last run (if nothing changed '
+                             'since). Requires the build cache', action='store_true', default=False)
     parser.add_argument('--dry-run', help='Perform a dry run only. This will not launch the competition infrastructure',
                         action='store_true', default=False)
     parser.add_argument('--debug', help='Enable debug mode', action='store_true', default=False)
@@ -95,7 +144,26 @@ def cli_main(base_dir=None):
     args.output = os.path.expanduser(args.output)
     args.data = os.path.expanduser(args.data)
 
-    main(logger, args)
+    if args.build_cache is not None:
+        args.build_cache = os.path.expanduser(args.build_cache)
+
+    args.platform_check_cache = os.path.expanduser(args.platform_check_cache)
+
+    try:
+        main(logger, args)
+    except KeyboardInterrupt:
+        logger.critical('Interrupted, terminating every running command')
+        CommandExecutor.terminate_all()
+        sys.exit(130)
+
+
+def _generate_steps(logger, args, strategy):
+    # Teams are rendered as the steps are generated, so config errors can still show up here
+    try:
+        yield from strategy.generate_steps()
+    except Exception as e:
+        logger.critical('Error in parsing YAML: %s', e)
+        fail(e, args.debug)
 
 
 def main(logger, args):
@@ -131,7 +199,11 @@ def main(logger, args):
 
     # Create the config
     try:
-        config = Config(raw_config, args.disable_platform_check)
+        check_cache = None
+        if args.platform_check_ttl > 0:
+            check_cache = PlatformCheckCache(args.platform_check_cache, args.platform_check_ttl)
+
+        config = Config(raw_config, args.disable_platform_check, args.platform_check_timeout, check_cache)
     except Exception as e:
         logger.critical('Error in config file: %s', e)
         fail(e, args.debug)
@@ -151,11 +223,28 @@ def main(logger, args):
     if args.dry_run:
         logger.info('Dry run enabled. Will not be executing the deployment.')
 
-    for step, deploy_config in strategy.generate_steps():
+    build_cache = None
+    if args.build_cache is not None:
+        logger.debug('Using build cache: %s', args.build_cache)
+        build_cache = BuildCache(args.build_cache)
+
+    # Every step in flight occupies its own stage, so deeper pipelines would never fill up
+    stages = len(DeployDispatcher.PIPELINE_STAGES)
+    if args.pipeline_depth > stages:
+        logger.warning('Only %d deployment steps can overlap, lowering --pipeline-depth from %d to %d',
+                       stages, args.pipeline_depth, stages)
+        args.pipeline_depth = stages
+
+    pipeline = None
+    if args.pipeline_depth > 1 and not args.dry_run:
+        logger.info('Pipelining enabled. Up to %d deployment steps will run at once.', args.pipeline_depth)
+        pipeline = DeployPipeline(args.pipeline_depth, stages)
+
+    for step, deploy_config in _generate_steps(logger, args, strategy):
         step_start_time = datetime.now()
         logger.info('Deployment strategy run #%d', step)
 
-        dispatcher = DeployDispatcher(step, config, args, deploy_config)
+        dispatcher = DeployDispatcher(step, config, args, deploy_config, build_cache)
 
         try:
             dispatcher.run_validate()
@@ -169,6 +258,16 @@ def main(logger, args):
             logger.critical('Fatal error when generating: %s', e)
             fail(e, args.debug)
 
+        if pipeline is not None:
+            try:
+                pipeline.submit(dispatcher, deploy_config.level)
+            except Exception as e:
+                logger.critical('Fatal error when executing: %s', e)
+                fail(e, args.debug)
+
+            # Execution continues in the background
+            continue
+
         if not args.dry_run:
             try:
                 dispatcher.run_execute()
@@ -180,6 +279,13 @@ def main(logger, args):
         step_run_time = datetime.now() - step_start_time
         logger.info('Deployment strategy #%d completed in %fs', step, step_run_time.total_seconds())
 
+    if pipeline is not None:
+        try:
+            pipeline.join()
+        except Exception as e:
+            logger.critical('Fatal error when executing: %s', e)
+            fail(e, args.debug)
+
     # Done
     main_run_time = datetime.now() - main_start_time
     logger.info('Genesis completed in %fs', main_run_time.total_seconds())
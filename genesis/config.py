@@ -1,3 +1,5 @@
+import threading
+import time
 from collections import UserDict
 from cerberus import Validator
 from genesis.platforms import PLATFORM_MAPPINGS
@@ -39,11 +41,16 @@ class Config(UserDict):
         },
     }
 
-    def __init__(self, config, dry_run):
+    # Seconds a platform gets to pass validation (including connecting to it)
+    PLATFORM_CHECK_TIMEOUT = 30
+
+    def __init__(self, config, dry_run, check_timeout=None, check_cache=None):
         super().__init__()
 
         self.data = config
         self.dry_run = dry_run
+        self.check_timeout = check_timeout if check_timeout is not None else self.PLATFORM_CHECK_TIMEOUT
+        self.check_cache = check_cache
 
         self.validate()
         self.parse()
@@ -55,12 +62,40 @@ class Config(UserDict):
 
     def parse(self):
         # Handle platforms
-        platforms = self.data['platforms'].copy()
-        for platform, config in platforms.items():
-            pf = PLATFORM_MAPPINGS[platform](config, self.dry_run)
+        platforms = {}
+        for platform, config in self.data['platforms'].items():
+            platforms[platform] = PLATFORM_MAPPINGS[config['type']](config, self.dry_run, self.check_cache)
+
+        # Validate them all at once, so one slow platform does not hold up the others
+        results = {}
+        threads = []
+        for platform, pf in platforms.items():
+            thread = threading.Thread(target=self._validate_platform, args=(pf, platform, results), daemon=True)
+            thread.start()
+            threads.append((platform, thread))
+
+        # Every platform started at the same time, so they share the same deadline
+        deadline = time.monotonic() + self.check_timeout
+
+        errors = {}
+        for platform, thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+            if platform not in results:
+                errors[platform] = ['Timed out after {}s'.format(self.check_timeout)]
+            elif results[platform]:
+                errors[platform] = results[platform]
+
+        if errors:
+            raise ConfigException(errors)
+
+        self.data['platforms'].update(platforms)
 
+    @staticmethod
+    def _validate_platform(pf, platform, results):
+        try:
             valid, errors = pf.validate()
-            if not valid:
-                raise ConfigException(errors)
+        except Exception as e:  # pylint: disable=broad-except
+            valid, errors = False, [str(e)]
 
-            self.data['platforms'][platform] = pf
+        results[platform] = [] if valid else errors
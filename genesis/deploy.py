@@ -7,6 +7,7 @@ class DeployStrategy(object):
         self.config = config
         self.nodes = {}
         self.strategy = []
+        self.critical_path = []
 
         self.logger = logging.getLogger(__name__)
 
@@ -22,25 +23,77 @@ class DeployStrategy(object):
 
             self.nodes[host['id']] = Node(host['id'], host.get('dependency', []))
 
-        # Keep creating strategies until we have no nodes
-        while self.nodes:
-            next_strategy = []
-            for hid, node in self.nodes.items():
-                has_uncompleted_deps = any(x in self.nodes for x in node.deps)
+        if self.args.disable_dependency:
+            if self.nodes:
+                self.strategy.append(list(self.nodes))
+            return
 
-                if not has_uncompleted_deps or self.args.disable_dependency:
-                    next_strategy.append(hid)
+        # Index the dependents of every node, and how many deps each node is still waiting on.
+        # Deps that are not being deployed are ignored
+        order = {hid: i for i, hid in enumerate(self.nodes)}
+        dependents = {hid: [] for hid in self.nodes}
+        pending = {}
 
-            # If we have a loop, next_stretegy will be empty
-            if not next_strategy:
-                raise Exception('Circular reference detected')
+        for hid, node in self.nodes.items():
+            deps = [x for x in dict.fromkeys(node.deps) if x in self.nodes]
+            pending[hid] = len(deps)
 
-            # Remove the elements from the nodelist
-            for hid in next_strategy:
-                del self.nodes[hid]
+            for dep in deps:
+                dependents[dep].append(hid)
+
+        # Kahn's algorithm, one strategy per "level" of the graph
+        next_strategy = [hid for hid in self.nodes if pending[hid] == 0]
+        resolved_by = {}
+        planned = 0
 
-            # Save the final strategy
+        while next_strategy:
             self.strategy.append(next_strategy)
+            planned += len(next_strategy)
+
+            ready = []
+            for hid in next_strategy:
+                for dependent in dependents[hid]:
+                    pending[dependent] -= 1
+
+                    if pending[dependent] == 0:
+                        ready.append(dependent)
+
+                        # The last dep to be resolved is always in the previous strategy
+                        resolved_by[dependent] = hid
+
+            next_strategy = sorted(ready, key=order.get)
+
+        # If we have a loop, some nodes never had all of their deps resolved
+        if planned != len(self.nodes):
+            cycle = self._find_cycle([hid for hid in self.nodes if pending[hid] > 0])
+            raise Exception('Circular reference detected: {}'.format(' -> '.join(cycle)))
+
+        # The critical path is the longest dependency chain, which sets the amount of strategies
+        if self.strategy:
+            hid = self.strategy[-1][0]
+            self.critical_path = [hid]
+
+            while hid in resolved_by:
+                hid = resolved_by[hid]
+                self.critical_path.insert(0, hid)
+
+            self.logger.info('Critical path (%d steps): %s',
+                             len(self.critical_path), ' -> '.join(self.critical_path))
+
+    def _find_cycle(self, remaining):
+        # Every remaining node depends on at least one other remaining node, so
+        # following those deps must eventually revisit a node
+        remaining = set(remaining)
+        path = {}
+        hid = next(x for x in self.nodes if x in remaining)
+
+        while hid not in path:
+            path[hid] = len(path)
+            hid = next(x for x in self.nodes[hid].deps if x in remaining)
+
+        cycle = list(path)[path[hid]:]
+
+        return cycle + [hid]
 
     def generate_steps(self):
         if not self.strategy:
@@ -51,54 +104,67 @@ class DeployStrategy(object):
             # Build the team config that need to be deployed
             teams = []
             vms_deployed_in_step = 0
+            strategy_hosts = set(strategy)
 
-            for team in self.config['teams']:
+            for i in range(len(self.config['teams'])):
                 if vms_deployed_in_step >= self.args.batch_deploys:
                     self.logger.debug('Deployed more than %s VMs in step #%d (%s). Chunking.',
                                       self.args.batch_deploys, step, vms_deployed_in_step)
                     self.logger.debug('Chunking steps = %d. Strategy step = %d',
                                       chunking_additional_steps, step)
 
-                    yield chunking_additional_steps + step, teams
+                    yield chunking_additional_steps + step, Deploy(self.config, teams, step)
 
                     # Reset
                     vms_deployed_in_step = 0
                     chunking_additional_steps += 1
                     teams = []
 
-                hosts = [x for x in team['hosts'] if x['id'] in strategy]
-                vms_deployed_in_step += len(hosts)
+                # Only render the hosts this strategy step deploys
+                team = self.config['teams'].expand(i, strategy_hosts)
+                vms_deployed_in_step += len(team['hosts'])
 
-                teams.append({
-                    'team': team['team'],
-                    'hosts': hosts
-                })
+                teams.append(team)
 
             if vms_deployed_in_step > 0:
-                yield chunking_additional_steps + step, Deploy(self.config, teams)
+                yield chunking_additional_steps + step, Deploy(self.config, teams, step)
 
 
 class Deploy(object):
-    def __init__(self, config, deploy):
+    def __init__(self, config, deploy, level=0):
         self.config = config
         self.deploy = deploy
+        self.level = level
         self.templates = {}
-        self.template_hosts = []
-        self.deploy_hosts = []
+        self.deploy_hosts = {}
         self.flat_deploy = []
 
+        # Indexes of every host being deployed
+        self.hosts_by_id = {}
+        self.hosts_by_template = {}
+        self.hosts_by_platform = {}
+        self.hosts_by_team = {}
+
         # Build the templates
         for tpl in config['templates']:
             self.templates[tpl['id']] = tpl
 
-        # Build a list of templates that are being deployed
+        # Index the hosts that are being deployed
         for team in deploy:
-            for host in team['hosts']:
-                if host['template'] not in self.template_hosts:
-                    self.template_hosts.append(host['template'])
+            # Teams can share a name (eg: when it has no "{team}"), keep the hosts of all of them
+            self.hosts_by_team.setdefault(team['team'], []).extend(team['hosts'])
 
+            for host in team['hosts']:
+                # The first host of every id represents that id (eg: for connection details)
                 if host['id'] not in self.deploy_hosts:
-                    self.deploy_hosts.append(host)
+                    self.deploy_hosts[host['id']] = host
+
+                self.hosts_by_id.setdefault(host['id'], []).append(host)
+                self.hosts_by_template.setdefault(host['template'], []).append(host)
+
+                if host['template'] in self.templates:
+                    platform = self.templates[host['template']]['virt_platform']
+                    self.hosts_by_platform.setdefault(platform, []).append(host)
 
                 self.flat_deploy.append(host)
 
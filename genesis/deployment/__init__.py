@@ -1,10 +1,51 @@
 import logging
-import os
+import threading
 from abc import abstractmethod
-from distutils.dir_util import copy_tree
-from shutil import copyfile
+from collections import defaultdict
 from cerberus import Validator
-from genesis.utils import hashid
+from genesis.deployment.staging import Stager
+
+
+class Job(object):
+    """
+    A named list of commands that are executed in order, optionally in their own
+    working directory. Deployers can return multiple jobs from execute(), which
+    are run concurrently with their own logs.
+
+    If inputs (paths and config values) are given, the job is skipped when the
+    build cache has a successful run with the same inputs. Commands listed in
+    exclusive (command index -> lock name) never run at the same time as another
+    command holding the same lock, in any job.
+
+    Jobs that know which of their targets (eg: hosts) failed can be retried for
+    only those targets, see failed_targets() and limit().
+    """
+
+    LOCKS = defaultdict(threading.Lock)
+
+    def __init__(self, name, cmds, cwd=None, inputs=None, exclusive=None, env=None):
+        self.name = name
+        self.cmds = cmds
+        self.cwd = cwd
+        self.inputs = inputs
+        self.exclusive = exclusive or {}
+        self.env = env or {}
+
+        # Filled in by the build cache
+        self.cache_key = None
+        self.fingerprint = None
+
+    def failed_targets(self):
+        """
+        Targets that failed during the last run, or None if unknown
+        """
+        return None
+
+    def limit(self, targets):  # pylint: disable=unused-argument
+        """
+        Limits the commands to the given targets. Returns False if the job can not be limited.
+        """
+        return False
 
 
 class BaseDeployer(object):
@@ -14,6 +55,9 @@ class BaseDeployer(object):
 
     SCHEMA = None
 
+    # Maximum amount of jobs from execute() to run at once (None being all of them)
+    EXECUTE_WORKERS = None
+
     # Internal configuration
     CUSTOM_POST_PROVISION_HOSTS = ['pfsense']
     LINUX_OS = ['pfsense', 'ubuntu', 'centos']
@@ -33,6 +77,7 @@ class BaseDeployer(object):
         self.config = config
         self.args = args
         self.deploy = deploy
+        self.execute_workers = self.EXECUTE_WORKERS
 
         if self.SCHEMA is not None:
             self.validator = Validator(self.SCHEMA, allow_unknown=True)
@@ -53,10 +98,14 @@ class BaseDeployer(object):
     def execute(self, data):
         pass
 
+    def cache_inputs(self, data):  # pylint: disable=unused-argument
+        """
+        Everything (paths and config values) the commands from execute() consume.
+        None means the commands can never be skipped by the build cache.
+        """
+        return None
+
     def _copy(self, src, dst):
-        self.logger.debug('Copying %s -> %s', src, dst)
+        self.logger.debug('Staging %s -> %s', src, dst)
 
-        if os.path.isdir(src):
-            copy_tree(src, dst)
-        else:
-            copyfile(src, dst)
+        Stager(self.args.output).stage(src, dst)
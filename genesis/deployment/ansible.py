@@ -1,7 +1,72 @@
+import configparser
 import logging
 import os
+import re
 import yaml
-from genesis.deployment import BaseDeployer
+from genesis.deployment import BaseDeployer, Job
+
+
+class AnsiblePlaybookJob(Job):
+    """
+    Runs an ansible playbook, which can be retried for the hosts that failed or were unreachable
+    (as reported by ansible's retry file)
+    """
+
+    RETRY_DIR = '.ansible-retry'
+
+    def __init__(self, name, playbook, cwd, inventory=None, limit=None, inputs=None, extra_args=None):
+        self.playbook = playbook
+        self.inventory = inventory
+        self.extra_args = extra_args or []
+        self.attempt = 0
+
+        # Every job gets its own retry file, as jobs can run at the same time
+        self.retry_dir = os.path.abspath("{}/{}/{}".format(cwd, self.RETRY_DIR, name))
+        self.retry_file = "{}/{}.retry".format(self.retry_dir, os.path.splitext(os.path.basename(playbook))[0])
+
+        env = {
+            'ANSIBLE_RETRY_FILES_ENABLED': 'True',
+            'ANSIBLE_RETRY_FILES_SAVE_PATH': self.retry_dir,
+        }
+
+        super().__init__(name, [self._cmd(limit)], cwd, inputs, env=env)
+
+    def failed_targets(self):
+        if not os.path.isfile(self.retry_file):
+            return None
+
+        with open(self.retry_file) as fp:
+            targets = [x.strip() for x in fp if x.strip()]
+
+        # A later run only writes it if something failed again
+        os.remove(self.retry_file)
+
+        return targets
+
+    def limit(self, targets):
+        self.attempt += 1
+
+        limit_file = "{}/limit-{}".format(self.retry_dir, self.attempt)
+        os.makedirs(self.retry_dir, exist_ok=True)
+
+        with open(limit_file, 'w') as fp:
+            fp.write('\n'.join(targets) + '\n')
+
+        self.cmds = [self._cmd('@{}'.format(limit_file))]
+        return True
+
+    def _cmd(self, limit):
+        cmd = ['ansible-playbook']
+        if self.inventory is not None:
+            cmd += ['-i', self.inventory]
+
+        cmd.append(self.playbook)
+        cmd += self.extra_args
+
+        if limit is not None:
+            cmd += ['--limit', limit]
+
+        return cmd
 
 
 class Ansible(BaseDeployer):
@@ -10,8 +75,35 @@ class Ansible(BaseDeployer):
     DESC = "Post-deployment configuration of a VM"
 
     ANSIBLE_INVENTORY = 'hosts'
+    ANSIBLE_YAML_INVENTORY = 'hosts.yml'
+    ANSIBLE_GROUP_VARS = 'group_vars'
+    ANSIBLE_HOST_VARS = 'host_vars'
     ANSIBLE_PLAYBOOK = '99-deploy-configure.yml'
     ANSIBLE_ROLES = 'ansible-roles'
+    ANSIBLE_CONFIG = 'ansible.cfg'
+    ANSIBLE_FACT_CACHE = '.ansible-facts'
+    ANSIBLE_TEAM_GROUP = 'team_{}'
+
+    # Forks scale with the hosts in the step, within these bounds
+    ANSIBLE_MIN_FORKS = 5
+    ANSIBLE_MAX_FORKS = 50
+
+    # Defaults of the generated ansible.cfg, the config's "ansible_config" overrides them.
+    # Retry files are left out, AnsiblePlaybookJob enables them for the jobs that need them.
+    ANSIBLE_CONFIG_DEFAULTS = {
+        'defaults': {
+            'strategy': 'linear',
+            'gathering': 'smart',
+            'fact_caching': 'jsonfile',
+            'fact_caching_timeout': '7200',
+            'host_key_checking': 'False',
+            'nocows': '1',
+        },
+        'ssh_connection': {
+            'pipelining': 'True',
+            'ssh_args': '-o ControlMaster=auto -o ControlPersist=300s',
+        },
+    }
 
     SCHEMA = {
         'templates': {
@@ -70,6 +162,12 @@ class Ansible(BaseDeployer):
                 'type': 'dict',
             },
         },
+        'ansible_config': {
+            'type': 'dict',
+            'valueschema': {
+                'type': 'dict',
+            },
+        },
     }
 
     def __init__(self, step, config, args, deploy):
@@ -77,10 +175,25 @@ class Ansible(BaseDeployer):
 
         self.logger = logging.getLogger(__name__)
 
+        # Every team gets its own ansible-playbook run, so a slow team only holds up itself
+        self.sharded = args.ansible_workers > 1 and len(deploy.hosts_by_team) > 1
+        self.execute_workers = args.ansible_workers
+        self.team_groups = self._team_groups()
+
+        self.inventory = self.ANSIBLE_YAML_INVENTORY if args.ansible_inventory == 'yaml' else self.ANSIBLE_INVENTORY
+
     def generate(self, data):
+        # Config
+        with open("{}/{}".format(data['step_dir'], self.ANSIBLE_CONFIG), 'w') as fp:
+            fp.write('\n'.join(self.AUTOGENERATED_HEADER))
+            self._generate_config().write(fp)
+
         # Inventory
-        with open("{}/{}".format(data['step_dir'], self.ANSIBLE_INVENTORY), 'w') as fp:
-            fp.write(self._generate_hosts())
+        if self.inventory == self.ANSIBLE_YAML_INVENTORY:
+            self._generate_yaml_hosts(data['step_dir'])
+        else:
+            with open("{}/{}".format(data['step_dir'], self.ANSIBLE_INVENTORY), 'w') as fp:
+                fp.write(self._generate_hosts())
 
         # Playbook
         with open("{}/{}".format(data['step_dir'], self.ANSIBLE_PLAYBOOK), 'w') as fp:
@@ -105,21 +218,69 @@ class Ansible(BaseDeployer):
             self.logger.debug("Not running ansible, as there are no roles for any host")
             return []
 
-        return [
-            ['ansible-playbook', '-i', self.ANSIBLE_INVENTORY, self.ANSIBLE_PLAYBOOK]
+        inputs = self.cache_inputs(data)
+        if not self.sharded:
+            return [AnsiblePlaybookJob(self.NAME, self.ANSIBLE_PLAYBOOK, data['step_dir'], self.inventory,
+                                       inputs=inputs)]
+
+        jobs = []
+        for group in self.team_groups.values():
+            jobs.append(AnsiblePlaybookJob(group, self.ANSIBLE_PLAYBOOK, data['step_dir'], self.inventory,
+                                           limit=group, inputs=inputs + [group]))
+
+        return jobs
+
+    def cache_inputs(self, data):
+        inputs = [
+            "{}/{}".format(data['step_dir'], self.ANSIBLE_CONFIG),
+            "{}/{}".format(data['step_dir'], self.inventory),
+            "{}/{}".format(data['step_dir'], self.ANSIBLE_PLAYBOOK),
+            "{}/{}".format(self.args.data, self.ANSIBLE_ROLES),
+            self.config.get('role_variables', {}),
+            self.config.get('ansible_galaxy_roles', []),
         ]
 
+        # YAML inventories keep their variables next to them
+        if self.inventory == self.ANSIBLE_YAML_INVENTORY:
+            inputs.append("{}/{}".format(data['step_dir'], self.ANSIBLE_GROUP_VARS))
+            inputs.append("{}/{}".format(data['step_dir'], self.ANSIBLE_HOST_VARS))
+
+        # Roles can use any of the included data
+        for copydata in self.config.get('included_copy_data', []):
+            inputs.append("{}/{}".format(data['step_dir'], copydata))
+
+        return inputs
+
+    def _generate_config(self):
+        cfg = configparser.ConfigParser(interpolation=None)
+        cfg.read_dict(self.ANSIBLE_CONFIG_DEFAULTS)
+
+        # Enough forks to configure every host of the step (or of the team, when sharded) at once
+        if self.sharded:
+            hosts = max([len(x) for x in self.deploy.hosts_by_team.values()])
+        else:
+            hosts = len(self.deploy.flat_deploy)
+
+        forks = min(max(hosts, self.ANSIBLE_MIN_FORKS), self.ANSIBLE_MAX_FORKS)
+        cfg.set('defaults', 'forks', str(forks))
+
+        # Facts are shared by every step, so hosts are only gathered once
+        cfg.set('defaults', 'fact_caching_connection',
+                os.path.abspath("{}/{}".format(self.args.output, self.ANSIBLE_FACT_CACHE)))
+
+        # Overrides from the config
+        cfg.read_dict({section: {k: str(v) for k, v in values.items()}
+                       for section, values in self.config.get('ansible_config', {}).items()})
+
+        return cfg
+
     def _generate_hosts(self):
         groups = {}
         for host in self.deploy.flat_deploy:
             if host['id'] not in groups:
                 groups[host['id']] = {'hosts': [], 'inline': []}
 
-            # Need to grab the primary IP
-            primary_ip = None
-            for net in host['networks']:
-                if primary_ip is None or (primary_ip is not None and net.get('primary', False)):
-                    primary_ip, _ = net['ip'].split('/', 2)
+            primary_ip = self._primary_ip(host)
 
             inline_cfg = []
             for role in host.get('roles', []):
@@ -139,44 +300,131 @@ class Ansible(BaseDeployer):
                 out.append('{}\t{}'.format(ip, ' '.join(cfg['inline'][i])))
             out.append('')
 
-        # Build the connection variables
-        vars_set_hosts = []
-        for host in self.deploy.deploy_hosts:
-            if host['id'] in vars_set_hosts:
-                continue
+        # Team groups, for --limit
+        for team, hosts in self.deploy.hosts_by_team.items():
+            out.append('[{}]'.format(self.team_groups[team]))
+            out += [self._primary_ip(host) for host in hosts]
+            out.append('')
 
+        # Build the connection variables
+        for host in self.deploy.deploy_hosts.values():
             out.append('[{}:vars]'.format(host['id']))
 
-            tpl = self.deploy.templates[host['template']]
-            if tpl['os'] in self.LINUX_OS:
-                out.append('ansible_user="{}"'.format(tpl['username']))
-                out.append('ansible_ssh_pass="{}"'.format(tpl['password']))
-                out.append('ansible_become_pass="{}"'.format(tpl['password']))
-                out.append('ansible_ssh_common_args="-o StrictHostKeyChecking=no"')
-            elif tpl['os'] in self.WINDOWS_OS:
-                out.append('ansible_connection=winrm')
-                out.append('ansible_port=5985')
-                out.append('ansible_user="{}"'.format(tpl['username']))
-                out.append('ansible_password="{}"'.format(tpl['password']))
-            else:
-                raise Exception('Unknown OS: {}'.format(tpl['os']))
-
-            for key, value in tpl.get('ansible_opts', {}).items():
-                out.append('{}="{}"'.format(key, value))
+            for key, value in self._connection_vars(host).items():
+                out.append('{}="{}"'.format(key, value) if isinstance(value, str) else '{}={}'.format(key, value))
 
             out.append('')
-            vars_set_hosts.append(host['id'])
 
         return '\n'.join(out)
 
+    def _generate_yaml_hosts(self, step_dir):
+        children = {}
+        host_vars = {}
+
+        for host_id, hosts in self.deploy.hosts_by_id.items():
+            group = {'hosts': {}}
+            group_vars = self._connection_vars(self.deploy.deploy_hosts[host_id])
+
+            role_vars = []
+            for host in hosts:
+                ip = self._primary_ip(host)
+                group['hosts'][ip] = None
+
+                host_role_vars = {}
+                for role in host.get('roles', []):
+                    host_role_vars.update(role.get('vars', {}))
+
+                role_vars.append((ip, host_role_vars))
+
+            # Values every host in the group agrees on are only written once, for the group
+            promoted = set()
+            for key, value in role_vars[0][1].items():
+                if all(key in x and x[key] == value for _, x in role_vars[1:]):
+                    group_vars[key] = value
+                    promoted.add(key)
+
+            # Role variables overriding a connection variable stay on the host
+            for ip, values in role_vars:
+                values = {k: v for k, v in values.items() if k not in promoted}
+                if values:
+                    host_vars.setdefault(ip, {}).update(values)
+
+            children[host_id] = group
+            self._write_yaml("{}/{}/{}.yml".format(step_dir, self.ANSIBLE_GROUP_VARS, host_id), group_vars)
+
+        # Team groups, for --limit
+        for team, hosts in self.deploy.hosts_by_team.items():
+            children[self.team_groups[team]] = {'hosts': {self._primary_ip(host): None for host in hosts}}
+
+        for ip, values in host_vars.items():
+            self._write_yaml("{}/{}/{}.yml".format(step_dir, self.ANSIBLE_HOST_VARS, ip), values)
+
+        self._write_yaml("{}/{}".format(step_dir, self.ANSIBLE_YAML_INVENTORY), {'all': {'children': children}})
+
+    def _write_yaml(self, filename, data):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        with open(filename, 'w') as fp:
+            fp.write('\n'.join(self.AUTOGENERATED_HEADER))
+            yaml.safe_dump(data, fp, default_flow_style=False)
+
+    def _connection_vars(self, host):
+        tpl = self.deploy.templates[host['template']]
+        if tpl['os'] in self.LINUX_OS:
+            out = {
+                'ansible_user': tpl['username'],
+                'ansible_ssh_pass': tpl['password'],
+                'ansible_become_pass': tpl['password'],
+                'ansible_ssh_common_args': '-o StrictHostKeyChecking=no',
+            }
+        elif tpl['os'] in self.WINDOWS_OS:
+            out = {
+                'ansible_connection': 'winrm',
+                'ansible_port': 5985,
+                'ansible_user': tpl['username'],
+                'ansible_password': tpl['password'],
+            }
+        else:
+            raise Exception('Unknown OS: {}'.format(tpl['os']))
+
+        out.update(tpl.get('ansible_opts', {}))
+
+        return out
+
+    def _team_groups(self):
+        # Team names can be anything, group names can not. Names that end up the same
+        # (eg: "Team 1" and "Team-1") get a suffix, so every team keeps its own group.
+        groups = {}
+        taken = set(self.deploy.hosts_by_id)
+
+        for team in self.deploy.hosts_by_team:
+            group = self.ANSIBLE_TEAM_GROUP.format(re.sub('[^a-zA-Z0-9_]', '_', team))
+
+            suffix = 1
+            unique = group
+            while unique in taken:
+                suffix += 1
+                unique = '{}_{}'.format(group, suffix)
+
+            groups[team] = unique
+            taken.add(unique)
+
+        return groups
+
+    @staticmethod
+    def _primary_ip(host):
+        # Need to grab the primary IP
+        primary_ip = None
+        for net in host['networks']:
+            if primary_ip is None or (primary_ip is not None and net.get('primary', False)):
+                primary_ip, _ = net['ip'].split('/', 2)
+
+        return primary_ip
+
     def _generate_deploy(self):
         out = []
 
-        included_hosts = []
-        for host in self.deploy.deploy_hosts:
-            if host['id'] in included_hosts:
-                continue
-
+        for host in self.deploy.deploy_hosts.values():
             out_host = {
                 'hosts': host['id'],
                 'tasks': [],
@@ -196,6 +444,5 @@ class Ansible(BaseDeployer):
                 out_host['tasks'].append(role_cfg)
 
             out.append(out_host)
-            included_hosts.append(host['id'])
 
         return out
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from genesis import __version__
+
+
+class BuildCache(object):
+    """
+    Records the content hash of every job that executed successfully.
+
+    A job's hash covers the genesis version and everything the job consumes (generated
+    files, data folders and config values). When a later run generates a job with the
+    same hash, it does not need to be executed again.
+
+    Jobs that failed for some of their targets (eg: hosts) have those targets recorded
+    with their hash, so a later run with the same hash can retry only those.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+        if os.path.isfile(path):
+            with open(path) as fp:
+                data = json.load(fp)
+
+            self.entries = data.get('jobs', {})
+            self.failed = data.get('failed', {})
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def fingerprint(self, key, inputs):
+        digest = hashlib.sha256()
+        digest.update(__version__.encode('utf-8'))
+        digest.update(key.encode('utf-8'))
+
+        for item in inputs:
+            if isinstance(item, str) and os.path.isdir(item):
+                self._hash_dir(digest, item)
+            elif isinstance(item, str) and os.path.isfile(item):
+                digest.update(os.path.basename(item).encode('utf-8'))
+                self._hash_file(digest, item)
+            else:
+                digest.update(json.dumps(item, sort_keys=True, default=self._to_json).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def is_fresh(self, key, fingerprint):
+        with self.lock:
+            return self.entries.get(key) == fingerprint
+
+    def record(self, key, fingerprint):
+        with self.lock:
+            self.entries[key] = fingerprint
+            self.failed.pop(key, None)
+            self._save()
+
+    def failed_targets(self, key, fingerprint):
+        with self.lock:
+            entry = self.failed.get(key)
+
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+
+        return entry['targets']
+
+    def record_failed(self, key, fingerprint, targets):
+        with self.lock:
+            self.failed[key] = {
+                'fingerprint': fingerprint,
+                'targets': targets,
+            }
+            self._save()
+
+    def _save(self):
+        # Write atomically, a half written cache is worse than none
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, 'w') as fp:
+            json.dump({'jobs': self.entries, 'failed': self.failed}, fp, indent=2, sort_keys=True)
+
+        os.replace(tmp, self.path)
+
+    def _hash_dir(self, digest, path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+
+                digest.update(os.path.relpath(filename, path).encode('utf-8'))
+                self._hash_file(digest, filename)
+
+    @staticmethod
+    def _hash_file(digest, path):
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                digest.update(block)
+
+    @staticmethod
+    def _to_json(obj):
+        # Platforms (and other config objects) are UserDicts
+        if hasattr(obj, 'data'):
+            return obj.data
+
+        return str(obj)
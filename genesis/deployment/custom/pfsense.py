@@ -1,27 +1,48 @@
 import yaml
 from genesis.deployment import BaseDeployer
+from genesis.deployment.ansible import AnsiblePlaybookJob
 
 
 class pfsenseProvision(BaseDeployer):
     PFSENSE_PROVISION_ROLE = 'pf_provision'
     PFSENSE_PROVISION_FILE = '05-deploy-postprovision.yml'
+    PFSENSE_PROVISION_INVENTORY = '05-deploy-postprovision-hosts.yml'
     PFSENSE_ANSIBLE_PROVISION = 'ansible-pfsense-provision'
+    PFSENSE_GROUP = 'pfsense'
+
+    # Maximum amount of pfSense hosts to provision at once
+    PFSENSE_MAX_FORKS = 20
 
     def generate(self, data):
-        # Generate the config
+        # Generate the inventory + config
+        with open("{}/{}".format(data['step_dir'], self.PFSENSE_PROVISION_INVENTORY), 'w') as fp:
+            fp.write(self._generate_inventory(data))
+
         with open("{}/{}".format(data['step_dir'], self.PFSENSE_PROVISION_FILE), 'w') as fp:
-            fp.write(self._generate_yml(data))
+            fp.write(self._generate_yml())
 
         # Copy over the roles
         self._copy("{}/{}".format(self.args.data, self.PFSENSE_ANSIBLE_PROVISION), "{}/roles".format(data['step_dir']))
 
     def execute(self, data):
+        # Every pfSense host is provisioned at once (up to a limit)
+        forks = min(len(data['post_provision_pfsense_hosts']), self.PFSENSE_MAX_FORKS)
+
+        return [
+            AnsiblePlaybookJob('pfsense', self.PFSENSE_PROVISION_FILE, data['step_dir'],
+                               self.PFSENSE_PROVISION_INVENTORY, inputs=self.cache_inputs(data),
+                               extra_args=['--forks', str(forks)])
+        ]
+
+    def cache_inputs(self, data):
         return [
-            ['ansible-playbook', self.PFSENSE_PROVISION_FILE]
+            "{}/{}".format(data['step_dir'], self.PFSENSE_PROVISION_INVENTORY),
+            "{}/{}".format(data['step_dir'], self.PFSENSE_PROVISION_FILE),
+            "{}/{}".format(self.args.data, self.PFSENSE_ANSIBLE_PROVISION),
         ]
 
-    def _generate_yml(self, data):
-        out = []
+    def _generate_inventory(self, data):
+        hosts = {}
 
         for host in data['post_provision_pfsense_hosts']:
             tpl = self.deploy.templates[host['template']]
@@ -35,31 +56,51 @@ class pfsenseProvision(BaseDeployer):
             lan = host['networks'][1]['ip']
             opt = host['networks'][2]['ip']
 
-            out_host = {
-                'hosts': 'localhost',
+            # Everything runs on localhost, the VM is reached through vSphere
+            vm_folder = "/{datacenter}/vm/{folder}".format(**host)
+            hosts["{}/{}".format(vm_folder, host['name'])] = {
+                'ansible_connection': 'local',
+                'vcenter_host': platform['host'],
+                'vcenter_user': platform['user'],
+                'vcenter_pass': platform['pass'],
+                'vcenter_dc': host['datacenter'],
+                'vm_folder': vm_folder,
+                'vm_id': host['name'],
+                'vm_user': tpl['username'],
+                'vm_pass': tpl['password'],
+                'cfg_gw': gw,
+                'cfg_wan': wan,
+                'cfg_lan': lan,
+                'cfg_opt': opt
+            }
+
+        out = {
+            'all': {
+                'children': {
+                    self.PFSENSE_GROUP: {
+                        'hosts': hosts,
+                    },
+                },
+            },
+        }
+
+        return '\n'.join(self.AUTOGENERATED_HEADER) + yaml.safe_dump(out, default_flow_style=False)
+
+    def _generate_yml(self):
+        # A single play covering every pfSense host, so they are provisioned (and waited for) concurrently
+        out = [
+            {
+                'hosts': self.PFSENSE_GROUP,
+                'gather_facts': False,
+                'strategy': 'free',
                 'tasks': [
                     {
                         'include_role': {
                             'name': self.PFSENSE_PROVISION_ROLE
                         },
-                        'vars': {
-                            'vcenter_host': platform['host'],
-                            'vcenter_user': platform['user'],
-                            'vcenter_pass': platform['pass'],
-                            'vcenter_dc': host['datacenter'],
-                            'vm_folder': "/{datacenter}/vm/{folder}".format(**host),
-                            'vm_id': host['name'],
-                            'vm_user': self.deploy.templates[host['template']]['username'],
-                            'vm_pass': self.deploy.templates[host['template']]['password'],
-                            'cfg_gw': gw,
-                            'cfg_wan': wan,
-                            'cfg_lan': lan,
-                            'cfg_opt': opt
-                        }
                     }
                 ],
             }
-
-            out.append(out_host)
+        ]
 
         return '\n'.join(self.AUTOGENERATED_HEADER) + yaml.dump(out)
@@ -1,8 +1,9 @@
+import asyncio
 import logging
 import os
-import subprocess
-import sys
 from datetime import datetime
+from genesis.deployment import Job
+from genesis.deployment.executor import CommandExecutor, Progress
 from genesis.deployment.ansible import Ansible
 from genesis.deployment.postprovision import PostProvisionDispatcher
 from genesis.deployment.terraform import Terraform
@@ -22,26 +23,41 @@ class DeployDispatcher(object):
         AnsibleGalaxyRoleDeploy.STEP, SetupCLIEnviron.STEP, DeployFolder.STEP
     ]
 
+    # Execution stages, in order. When pipelining, a stage of one chunk can overlap
+    # with the previous stage of the next chunk (eg: cloning while configuring)
+    PIPELINE_STAGES = [
+        [AnsibleGalaxyRoleDeploy, SetupCLIEnviron, DeployFolder, Terraform, VMwareNetworkFixer],
+        [PostProvisionDispatcher, Ansible, CopyData],
+    ]
+
     EXECUTE_LOGS_DIR = 'logs'
 
-    def __init__(self, stepnum, config, args, deploy):
+    def __init__(self, stepnum, config, args, deploy, build_cache=None):
         self.step = stepnum
         self.config = config
         self.args = args
         self.deploy = deploy
+        self.build_cache = build_cache
         self.deployers = {}
         self.deploy_data = {}
 
+        # Build cache state of the jobs that already ran in this step, later jobs depend on them
+        self.upstream = []
+        self.upstream_ran = False
+
         self.logger = logging.getLogger(__name__)
 
-        for step in self.DEPLOYMENT_STEPS:
+        # Steps are removed below, so each dispatcher needs its own copy
+        self.deployment_steps = list(self.DEPLOYMENT_STEPS)
+
+        for step in self.deployment_steps:
             self.deployers[step.NAME] = step(stepnum, config, args, deploy)
 
         # Handle --only-steps and --not-steps
         if args.only_steps is not None:
-            remove = [x for x in self.DEPLOYMENT_STEPS if x.STEP not in args.only_steps]
+            remove = [x for x in self.deployment_steps if x.STEP not in args.only_steps]
         elif args.not_steps is not None:
-            remove = [x for x in self.DEPLOYMENT_STEPS if x.STEP in args.not_steps]
+            remove = [x for x in self.deployment_steps if x.STEP in args.not_steps]
         else:
             remove = []
 
@@ -50,16 +66,16 @@ class DeployDispatcher(object):
 
         # Remove
         for step in remove:
-            self.DEPLOYMENT_STEPS.remove(step)
+            self.deployment_steps.remove(step)
 
         if remove:
             self.logger.debug('Removing the following deployment steps: %s', [x.NAME for x in remove])
-            self.logger.debug('Deployment steps remaining: %s', [x.NAME for x in self.DEPLOYMENT_STEPS])
+            self.logger.debug('Deployment steps remaining: %s', [x.NAME for x in self.deployment_steps])
 
     def run_validate(self):
         errors = []
 
-        for step in self.DEPLOYMENT_STEPS:
+        for step in self.deployment_steps:
             valid, validator_errors = self.deployers[step.NAME].validate()
             if not valid:
                 errors.append({
@@ -76,11 +92,11 @@ class DeployDispatcher(object):
             raise Exception('%d deployment steps failed to pass validation', len(errors))
 
     def run_generate(self):
-        for _, step in enumerate(self.DEPLOYMENT_STEPS):
+        for _, step in enumerate(self.deployment_steps):
             self.logger.debug('Running .generate() for %s', step.NAME)
             self.deployers[step.NAME].generate(self.deploy_data)
 
-    def run_execute(self):
+    def run_execute(self, stage=None):
         # Ensure log directory exists
         logfolder = "{}/{}".format(self.args.output, self.EXECUTE_LOGS_DIR)
         if not os.path.exists(logfolder):
@@ -90,7 +106,11 @@ class DeployDispatcher(object):
         # Set the ENV for the commands
         cmdenv = self.deploy_data['cli_environ']
 
-        for stepnum, step in enumerate(self.DEPLOYMENT_STEPS):
+        for stepnum, step in enumerate(self.deployment_steps):
+            # Only run the steps for the requested stage
+            if stage is not None and step not in self.PIPELINE_STAGES[stage]:
+                continue
+
             self.logger.debug('Running .execute() for %s', step.NAME)
             cmds = self.deployers[step.NAME].execute(self.deploy_data)
 
@@ -100,20 +120,176 @@ class DeployDispatcher(object):
             if cmds is None or not cmds:
                 continue
 
-            # Open output file
-            logfile = "step{}-action{}-{}.log".format(self.step, stepnum, step.NAME)
-            fp = open("{}/{}".format(logfolder, logfile), 'w')
+            # Plain commands are a single job
+            if not isinstance(cmds[0], Job):
+                cmds = [Job(step.NAME, cmds, inputs=self.deployers[step.NAME].cache_inputs(self.deploy_data))]
+
+            # Skip anything that already ran successfully with the same inputs
+            jobs = [x for x in cmds if not self._is_cached(step, x)]
+
+            # Anything after this depends on it (eg: ansible configuring the VMs terraform just created)
+            self.upstream += [x.fingerprint for x in cmds if x.fingerprint is not None]
+            if any(x.inputs is not None for x in jobs):
+                self.upstream_ran = True
+
+            if not jobs:
+                continue
+
+            # Output file(s), one per job
+            logfile = "{}/step{}-action{}-{}".format(logfolder, self.step, stepnum, step.NAME)
+
+            if len(jobs) == 1:
+                logfiles = [logfile + ".log"]
+            else:
+                logfiles = ["{}-{}.log".format(logfile, job.name) for job in jobs]
+
+            workers = min(self.deployers[step.NAME].execute_workers or len(jobs),
+                          self.args.execute_workers or len(jobs))
+            self.logger.debug('Running %d jobs for %s (%d at once)', len(jobs), step.NAME, workers)
+
+            failures = asyncio.run(self._run_jobs(step, jobs, logfiles, cmdenv, workers))
+            if failures:
+                for job, cmd, reason in failures:
+                    self.logger.critical('%s: %s', job.name, reason)
+                    if cmd is not None:
+                        self.logger.critical(cmd)
+
+                raise Exception('{} had {} of {} jobs fail ({})'.format(
+                    step.NAME, len(failures), len(jobs), ', '.join([x[0].name for x in failures])))
+
+    async def _run_jobs(self, step, jobs, logfiles, cmdenv, workers):
+        executor = CommandExecutor(self.args.command_timeout)
+        semaphore = asyncio.Semaphore(workers)
+        progress = Progress(step.NAME, len(jobs))
+
+        reporter = asyncio.ensure_future(progress.report())
+        tasks = {asyncio.ensure_future(self._run_job(executor, semaphore, progress, job, logfile, cmdenv)): job
+                 for job, logfile in zip(jobs, logfiles)}
+        pending = list(tasks)
+
+        failures = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                failures += [x.result() for x in done if x.result() is not None]
+
+                # Stop everything else of this step, rather than waiting for it
+                if failures and pending and self.args.fail_fast:
+                    self.logger.warning('%s failed, cancelling its %d other running jobs', step.NAME, len(pending))
+
+                    for task in pending:
+                        task.cancel()
+
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    failures += [(tasks[task], None, 'Cancelled') for task in pending if task.cancelled()]
+                    break
+        finally:
+            reporter.cancel()
+
+        return failures
+
+    async def _run_job(self, executor, semaphore, progress, job, logfile, cmdenv):
+        cwd = job.cwd if job.cwd is not None else self.deploy_data['step_dir']
+        env = dict(cmdenv, **job.env) if job.env else cmdenv
+
+        async with semaphore:
+            progress.start(job.name)
+            success = False
+
+            try:
+                with open(logfile, 'w') as fp:
+                    failure = await self._run_attempts(executor, progress, job, cwd, env, fp)
+                    success = failure is None
+            finally:
+                progress.finish(job.name, success)
+
+        if failure is None and job.fingerprint is not None:
+            self.build_cache.record(job.cache_key, job.fingerprint)
+
+        return failure
+
+    async def _run_attempts(self, executor, progress, job, cwd, env, fp):
+        start = 0
+        attempt = 0
+
+        while True:
+            failure = await self._run_cmds(executor, progress, job, start, cwd, env, fp)
+            if failure is None:
+                return None
+
+            start, cmd, retcode = failure
+
+            # Retry only what failed, if the job knows what that is
+            targets = job.failed_targets()
+            if attempt < self.args.retries and targets and job.limit(targets):
+                attempt += 1
+                delay = self.args.retry_backoff * 2 ** (attempt - 1)
+
+                self.logger.warning('%s failed on %d targets, retrying them in %ds (attempt %d of %d)',
+                                    job.name, len(targets), delay, attempt, self.args.retries)
+                fp.write('\n### Retrying {} in {}s (attempt {} of {}): {}\n\n'.format(
+                    job.name, delay, attempt, self.args.retries, ', '.join(targets)))
+                fp.flush()
+
+                await asyncio.sleep(delay)
+                continue
+
+            # Remember what failed, for --retry-failed
+            if targets and job.fingerprint is not None:
+                self.build_cache.record_failed(job.cache_key, job.fingerprint, targets)
+
+            if retcode is None:
+                return job, cmd, 'The following CMD timed out, or was never started'
+
+            return job, cmd, 'The following CMD returned a non-zero exit code ({})'.format(retcode)
+
+    async def _run_cmds(self, executor, progress, job, start, cwd, env, fp):
+        for i, cmd in enumerate(job.cmds[start:], start):
+            self.logger.debug('Running CMD: %s', cmd)
+
+            cmd_start_time = datetime.now()
+            if i in job.exclusive:
+                lock = Job.LOCKS[job.exclusive[i]]
+
+                # Locks are shared with other threads (pipelined steps), so poll rather than block the loop
+                while not lock.acquire(blocking=False):
+                    await asyncio.sleep(0.1)
+
+                try:
+                    retcode = await executor.run(job.name, cmd, cwd, env, fp, progress)
+                finally:
+                    lock.release()
+            else:
+                retcode = await executor.run(job.name, cmd, cwd, env, fp, progress)
+            cmd_run_time = datetime.now() - cmd_start_time
+
+            self.logger.debug('CMD completed in %fs', cmd_run_time.total_seconds())
+
+            if retcode != 0:
+                return i, cmd, retcode
+
+        return None
+
+    def _is_cached(self, step, job):
+        if self.build_cache is None or job.inputs is None:
+            return False
+
+        job.cache_key = "{}/step{}/{}/{}".format(self.config['name'], self.step, step.NAME, job.name)
+        job.fingerprint = fingerprint = self.build_cache.fingerprint(job.cache_key, job.inputs + self.upstream)
 
-            for cmd in cmds:
-                self.logger.debug('Running CMD: %s', cmd)
+        # Something this job depends on just ran, so whatever it did before may be gone
+        if self.upstream_ran:
+            return False
 
-                cmd_start_time = datetime.now()
-                retcode = subprocess.call(cmd, cwd=self.deploy_data['step_dir'], env=cmdenv, stdout=fp)
-                cmd_run_time = datetime.now() - cmd_start_time
+        if self.build_cache.is_fresh(job.cache_key, fingerprint):
+            self.logger.info('Skipping %s (%s), it is unchanged since its last successful run', step.NAME, job.name)
+            return True
 
-                self.logger.debug('CMD completed in %fs', cmd_run_time.total_seconds())
+        # Only run what failed last time, if nothing changed since
+        if self.args.retry_failed:
+            targets = self.build_cache.failed_targets(job.cache_key, fingerprint)
+            if targets and job.limit(targets):
+                self.logger.info('Resuming %s (%s), only for the %d targets that failed last time: %s',
+                                 step.NAME, job.name, len(targets), ', '.join(targets))
 
-                if retcode != 0:
-                    self.logger.critical('The following CMD returned a non-zero exit code (%d)', retcode)
-                    self.logger.critical(cmd)
-                    sys.exit(1)
+        return False
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+
+
+class CommandExecutor(object):
+    """
+    Runs commands as asyncio subprocesses, streaming their output (stdout and stderr) line by
+    line to a log file, the debug log and a progress view.
+
+    Every command runs in its own process group, so it can be terminated along with everything
+    it started (eg: the ssh processes of ansible) when it times out, gets cancelled, or genesis
+    is interrupted.
+    """
+
+    # Seconds between SIGTERM and SIGKILL when terminating a process group
+    TERMINATE_GRACE = 10
+
+    # Seconds to keep reading a command's output after it exited
+    DRAIN_TIMEOUT = 5
+
+    # Longest line read from a command's output
+    STREAM_LIMIT = 16 * 1024 * 1024
+
+    # Process groups of every running command, in every thread
+    PROCESSES = set()
+    LOCK = threading.Lock()
+    STOPPED = False
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or None
+
+        self.logger = logging.getLogger(__name__)
+
+    async def run(self, name, cmd, cwd, env, fp, progress=None):
+        """
+        Runs a command, returning its exit code (or None if it timed out, or could not be started)
+        """
+        if self.STOPPED:
+            return None
+
+        # Starting the process must not be cancelled halfway, or it can not be terminated
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True, limit=self.STREAM_LIMIT))
+
+        try:
+            proc = await asyncio.shield(spawn)
+        except OSError as e:
+            # eg: the command is not installed, or the working directory is gone
+            self.logger.error('%s: Unable to start CMD %s: %s', name, cmd[0], e)
+            fp.write('\n### Unable to start {}: {}\n'.format(cmd[0], e))
+
+            return None
+        except asyncio.CancelledError:
+            try:
+                await self._terminate(await spawn)
+            except OSError:
+                pass
+
+            raise
+
+        with self.LOCK:
+            self.PROCESSES.add(proc.pid)
+
+        streams = [asyncio.ensure_future(self._stream(name, proc.stdout, fp, progress)),
+                   asyncio.ensure_future(self._stream(name, proc.stderr, fp, progress))]
+
+        try:
+            await asyncio.wait_for(proc.wait(), self.timeout)
+
+            # Read what is left, unless something the command left behind keeps its output open
+            _, pending = await asyncio.wait(streams, timeout=self.DRAIN_TIMEOUT)
+            await self._cancel(pending)
+
+            return proc.returncode
+        except asyncio.TimeoutError:
+            self.logger.error('%s: CMD timed out after %ds, terminating it', name, self.timeout)
+
+            await self._terminate(proc)
+            await self._cancel(streams)
+            fp.write('\n### Timed out after {}s\n'.format(self.timeout))
+
+            return None
+        except asyncio.CancelledError:
+            await self._terminate(proc)
+            await self._cancel(streams)
+            raise
+        finally:
+            with self.LOCK:
+                self.PROCESSES.discard(proc.pid)
+
+    @classmethod
+    def terminate_all(cls):
+        """
+        Terminates every running command (of every thread), and refuses to start new ones
+        """
+        cls.STOPPED = True
+
+        with cls.LOCK:
+            pids = list(cls.PROCESSES)
+
+        cls._signal(pids, signal.SIGTERM)
+
+        # Commands are removed once their process exits
+        deadline = time.monotonic() + cls.TERMINATE_GRACE
+        while time.monotonic() < deadline:
+            with cls.LOCK:
+                if not cls.PROCESSES:
+                    return
+
+            time.sleep(0.1)
+
+        with cls.LOCK:
+            cls._signal(list(cls.PROCESSES), signal.SIGKILL)
+
+    async def _stream(self, name, stream, fp, progress):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # The rest of the line is dropped
+                line = b'(line too long, truncated)\n'
+
+            if not line:
+                break
+
+            text = line.decode('utf-8', 'replace').rstrip('\r\n')
+            fp.write(text + '\n')
+            fp.flush()
+
+            self.logger.debug('[%s] %s', name, text)
+            if progress is not None:
+                progress.output(name, text)
+
+    @staticmethod
+    async def _cancel(tasks):
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _terminate(self, proc):
+        self._signal([proc.pid], signal.SIGTERM)
+
+        try:
+            await asyncio.wait_for(proc.wait(), self.TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            self._signal([proc.pid], signal.SIGKILL)
+            await proc.wait()
+
+    @staticmethod
+    def _signal(pids, sig):
+        for pid in pids:
+            try:
+                os.killpg(pid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+class Progress(object):
+    """
+    Periodically logs which jobs of a deployment step are running, and their latest output
+    """
+
+    INTERVAL = 30
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.finished = 0
+        self.running = {}
+
+        self.logger = logging.getLogger(__name__)
+
+    def start(self, job):
+        self.running[job] = [time.monotonic(), '']
+
+    def output(self, job, line):
+        if job in self.running and line.strip():
+            self.running[job][1] = line.strip()
+
+    def finish(self, job, success):
+        started, _ = self.running.pop(job, [time.monotonic(), ''])
+        self.finished += 1
+
+        self.logger.info('%s: %s %s after %ds (%d of %d jobs done)', self.name, job,
+                         'completed' if success else 'failed', time.monotonic() - started, self.finished, self.total)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+
+            now = time.monotonic()
+            for job, (started, line) in self.running.items():
+                self.logger.info('%s: %s running for %ds: %s', self.name, job, now - started, line[:200])
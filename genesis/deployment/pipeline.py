@@ -0,0 +1,102 @@
+import logging
+import threading
+from datetime import datetime
+
+
+class DeployPipeline(object):
+    """
+    Executes the deployment strategy steps (chunks) with their stages overlapping.
+
+    Every stage of a chunk runs after the same stage of the previous chunk, so at most one
+    chunk is in each stage at a time. Chunks of the next strategy level only start once
+    every chunk of the current level has fully completed, to honour the dependencies.
+    """
+
+    def __init__(self, depth, stages):
+        self.depth = max(1, depth)
+        self.stages = stages
+        self.inflight = []
+        self.level = None
+        self.error = None
+
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, dispatcher, level):
+        self._raise_error()
+
+        # The next strategy level depends on the current one being completed
+        if self.level is not None and level != self.level:
+            self.logger.debug('Waiting for strategy level %d to complete before starting level %d', self.level, level)
+            self.join()
+
+        self.level = level
+
+        # Bound the amount of chunks in flight
+        while len(self.inflight) >= self.depth:
+            self.inflight.pop(0).thread.join()
+            self._raise_error()
+
+        previous = self.inflight[-1] if self.inflight else None
+        run = PipelineRun(self, dispatcher, previous)
+        self.inflight.append(run)
+
+        self.logger.debug('Pipelining deployment strategy run #%d (%d in flight)', dispatcher.step, len(self.inflight))
+        run.thread.start()
+
+    def join(self):
+        while self.inflight:
+            self.inflight.pop(0).thread.join()
+
+        self._raise_error()
+
+    def fail(self, error):
+        # Only the first error is kept, anything after it is most likely fallout
+        if self.error is None:
+            self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            # Let everything already in flight wind down
+            for run in self.inflight:
+                run.thread.join()
+
+            self.inflight = []
+            raise self.error
+
+
+class PipelineRun(object):
+    def __init__(self, pipeline, dispatcher, previous):
+        self.pipeline = pipeline
+        self.dispatcher = dispatcher
+        self.previous = previous
+        self.stages_done = [threading.Event() for _ in range(pipeline.stages)]
+        self.thread = threading.Thread(target=self.run, name='genesis-step{}'.format(dispatcher.step))
+
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        start_time = datetime.now()
+
+        try:
+            for stage, done in enumerate(self.stages_done):
+                # Wait for the previous chunk to leave this stage
+                if self.previous is not None:
+                    self.previous.stages_done[stage].wait()
+
+                if self.pipeline.error is not None:
+                    return
+
+                self.logger.debug('Deployment strategy run #%d entering stage %d', self.dispatcher.step, stage)
+                self.dispatcher.run_execute(stage)
+                done.set()
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.critical('Deployment strategy run #%d failed: %s', self.dispatcher.step, e)
+            self.pipeline.fail(e)
+            return
+        finally:
+            # Never leave the next chunk waiting on us
+            for done in self.stages_done:
+                done.set()
+
+        run_time = datetime.now() - start_time
+        self.logger.info('Deployment strategy #%d executed in %fs', self.dispatcher.step, run_time.total_seconds())
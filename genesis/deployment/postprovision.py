@@ -24,12 +24,8 @@ class PostProvisionDispatcher(BaseDeployer):
 
         # Grab all the hosts that will require custom workflows
         for template in templates:
-            hosts = []
             tid = template['id']
-
-            for host in self.deploy.flat_deploy:
-                if host['template'] == tid:
-                    hosts.append(host)
+            hosts = self.deploy.hosts_by_template.get(tid, [])
 
             # Run the workflow
             if hosts:
@@ -49,3 +45,14 @@ class PostProvisionDispatcher(BaseDeployer):
             cmds += p.execute(data)
 
         return cmds
+
+    def cache_inputs(self, data):
+        inputs = []
+        for p in self.provisioners:
+            p_inputs = p.cache_inputs(data)
+            if p_inputs is None:
+                return None
+
+            inputs += p_inputs
+
+        return inputs
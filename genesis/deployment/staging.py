@@ -0,0 +1,110 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+
+class Stager(object):
+    """
+    Stages data into step directories without copying it every time.
+
+    Every file is stored once in a content-addressed store under the output folder. Step
+    directories then get a hard link, reflink or symlink to the stored file (in that order
+    of preference), and only fall back to a real copy if the filesystem supports none of them.
+    """
+
+    STORE_DIR = '.stage-store'
+
+    # Linux ioctl to clone (reflink) a file
+    FICLONE = 0x40049409
+
+    # Content hashes of source files, keyed by their path, size and mtime
+    HASHES = {}
+    HASHES_LOCK = threading.Lock()
+
+    def __init__(self, output):
+        self.store = "{}/{}".format(output, self.STORE_DIR)
+
+        self.logger = logging.getLogger(__name__)
+
+    def stage(self, src, dst):
+        if not os.path.isdir(src):
+            self._stage_file(src, dst)
+            return
+
+        for root, _, files in os.walk(src, followlinks=True):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(dst_root, exist_ok=True)
+
+            for name in files:
+                self._stage_file(os.path.join(root, name), os.path.join(dst_root, name))
+
+    def _stage_file(self, src, dst):
+        stored = self._store(src)
+
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        for method in [os.link, self._reflink, self._symlink]:
+            try:
+                method(stored, dst)
+                return
+            except OSError:
+                continue
+
+        shutil.copy2(stored, dst)
+
+    def _store(self, src):
+        digest = self._hash(src)
+        stored = "{}/{}/{}".format(self.store, digest[:2], digest)
+
+        if not os.path.exists(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+
+            # Never link the source itself, otherwise editing it would change the store
+            tmp = "{}.{}.tmp".format(stored, threading.get_ident())
+            try:
+                self._reflink(src, tmp)
+            except OSError:
+                shutil.copy2(src, tmp)
+
+            shutil.copymode(src, tmp)
+            os.replace(tmp, stored)
+
+        return stored
+
+    def _hash(self, src):
+        stat = os.stat(src)
+        key = (os.path.realpath(src), stat.st_size, stat.st_mtime_ns)
+
+        with self.HASHES_LOCK:
+            if key in self.HASHES:
+                return self.HASHES[key]
+
+        digest = hashlib.sha256()
+        with open(src, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                digest.update(block)
+
+        # The mode is part of the content, as hard links share it
+        digest.update(oct(stat.st_mode & 0o7777).encode('utf-8'))
+
+        with self.HASHES_LOCK:
+            self.HASHES[key] = digest.hexdigest()
+
+        return self.HASHES[key]
+
+    def _reflink(self, src, dst):
+        with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), self.FICLONE, src_fp.fileno())
+            except OSError:
+                dst_fp.close()
+                os.remove(dst)
+                raise
+
+    @staticmethod
+    def _symlink(src, dst):
+        os.symlink(os.path.abspath(src), dst)
@@ -1,6 +1,8 @@
 import logging
-from genesis.deployment import BaseDeployer
-from genesis.deployment.terraform.vmware import VMwareGenerator
+import os
+from genesis.deployment import BaseDeployer, Job
+from genesis.deployment.terraform.compact import Blueprint
+from genesis.deployment.terraform.vmware import VMwareGenerator, VMwareJSONGenerator
 
 
 class Terraform(BaseDeployer):
@@ -10,11 +12,17 @@ class Terraform(BaseDeployer):
 
     TERRAFORM_FILE = '01-provision-{}.tf'
     TERRAFORM_PLAN = '.tfplan'
+    TERRAFORM_WORKSPACE = 'terraform-{}'
 
     CAN_CUSTOMIZE_OS = ['ubuntu', 'centos', 'windows']
 
     TERRAFORM_GENERATORS = {
-        'vmware': VMwareGenerator
+        'hcl': {
+            'vmware': VMwareGenerator
+        },
+        'json': {
+            'vmware': VMwareJSONGenerator
+        },
     }
 
     # pylint: disable=anomalous-backslash-in-string
@@ -180,50 +188,96 @@ class Terraform(BaseDeployer):
             return valid, errors
 
         # Ensure we have generators for Terraform
+        generators = self.TERRAFORM_GENERATORS[self.args.terraform_format]
         for name, platform in self.config['platforms'].items():
-            if platform['type'] not in self.TERRAFORM_GENERATORS:
+            if platform['type'] not in generators:
                 raise Exception('Unable to provision type {}'.format(platform['type']))
 
-            self.generators[name] = self.TERRAFORM_GENERATORS[platform['type']](name, platform, self)
+            self.generators[name] = generators[platform['type']](name, platform, self)
 
         # We're good
         return True, []
 
     def generate(self, data):
-        # Grab the terraform config
-        config = self._generate_tf_config()
+        workspaces = {}
+        files = {}
 
-        for name, cfg in config.items():
-            self.logger.debug('Generating terraform file for provider %s (%s)',
-                              name, self.TERRAFORM_FILE.format(name))
+        blueprints = {}
 
-            with open("{}/{}".format(data['step_dir'], self.TERRAFORM_FILE.format(name)), 'w') as fp:
-                fp.write('\n'.join(cfg))
+        try:
+            # Stream the config(s), one host at a time
+            for team in self.deploy.deploy:
+                for host in team['hosts']:
+                    if host['template'] not in self.deploy.templates:
+                        raise Exception('Failed to find template for {}'.format(host['template']))
 
-    def execute(self, data):
-        return [
-            ['terraform', 'init'],
-            ['terraform', 'plan', '-out', self.TERRAFORM_PLAN],
-            ['terraform', 'apply', self.TERRAFORM_PLAN]
-        ]
+                    template = self.deploy.templates[host['template']]
+                    platform = template['virt_platform']
+
+                    if platform not in files:
+                        # Every platform gets its own working directory (and state), so they can run concurrently
+                        workspace = "{}/{}".format(data['step_dir'], self.TERRAFORM_WORKSPACE.format(platform))
+                        os.makedirs(workspace)
+
+                        filename = self.TERRAFORM_FILE.format(platform) + self.generators[platform].EXTENSION
+                        self.logger.debug('Generating terraform file for provider %s (%s)', platform, filename)
+
+                        workspaces[platform] = workspace
+                        files[platform] = open("{}/{}".format(workspace, filename), 'w')
+                        self.generators[platform].open(files[platform])
+
+                    # Compact mode needs every team's host first
+                    if self.args.terraform_compact:
+                        blueprints.setdefault((platform, host['id']), []).append((team, host))
+                        continue
 
-    def _generate_tf_config(self):
-        tfconfig = {}
+                    # Call the generator to create this bad boy up
+                    self.generators[platform].write_host(template, host, team)
 
-        # Generate the config(s)
-        for team in self.deploy.deploy:
-            for host in team['hosts']:
-                if host['template'] not in self.deploy.templates:
-                    raise Exception('Failed to find template for {}'.format(host['template']))
+            # One resource per host id, when the teams allow it
+            for (platform, host_id), entries in blueprints.items():
+                template = self.deploy.templates[entries[0][1]['template']]
+                blueprint = Blueprint(host_id, entries)
+
+                if blueprint.compactable:
+                    self.generators[platform].write_blueprint(template, blueprint)
+                    continue
+
+                self.logger.debug('Host %s differs between teams in a way for_each can not express. '
+                                  'Generating a resource per team.', host_id)
+
+                for team, host in entries:
+                    self.generators[platform].write_host(template, host, team)
+        finally:
+            for platform, fp in files.items():
+                self.generators[platform].close()
+                fp.close()
+
+        data['terraform_workspaces'] = workspaces
+        data['terraform_files'] = {platform: fp.name for platform, fp in files.items()}
+
+    def execute(self, data):
+        # Providers come from the shared plugin cache, or the local mirror if there is one
+        init = ['terraform', 'init', '-input=false']
+        if data.get('terraform_plugin_mirror') is not None:
+            init.append('-plugin-dir={}'.format(data['terraform_plugin_mirror']))
 
-                template = self.deploy.templates[host['template']]
-                platform = template['virt_platform']
+        jobs = []
+        for name, workspace in data['terraform_workspaces'].items():
+            # Throttle terraform to what the platform can handle right now
+            parallelism = '-parallelism={}'.format(
+                self.generators[name].parallelism(self.deploy.hosts_by_platform.get(name, [])))
+            self.logger.debug('Running terraform for %s with %s', name, parallelism)
 
-                # Call the generator to create this bad boy up
-                if platform not in tfconfig:
-                    tfconfig[platform] = [] + self.AUTOGENERATED_HEADER
-                    tfconfig[platform].append(self.generators[platform].generate_provider())
+            cmds = [
+                init,
+                ['terraform', 'plan', parallelism, '-out', self.TERRAFORM_PLAN],
+                ['terraform', 'apply', parallelism, self.TERRAFORM_PLAN]
+            ]
 
-                tfconfig[platform].append(self.generators[platform].generate_host(template, host, team))
+            # The plugin cache is not safe for concurrent use, so only one init runs at a time
+            jobs.append(Job(name, cmds, workspace,
+                            inputs=[data['terraform_files'][name]],
+                            exclusive={0: 'terraform-init'}))
 
-        return tfconfig
+        return jobs
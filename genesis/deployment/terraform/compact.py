@@ -0,0 +1,117 @@
+import re
+
+
+class Blueprint(object):
+    """
+    Folds the same host of every team into one host, for a single for_each resource.
+
+    Every string that differs between teams is replaced by "${each.value.<key>}", and the
+    per team values end up in the for_each map. If the teams differ in a way a single
+    resource cannot express (eg: another datastore, or a different amount of disks), the
+    blueprint is not compactable and the hosts have to be generated one by one.
+    """
+
+    # Fields used by the generators that can differ per team
+    VARYING_FIELDS = ['name', 'folder', 'hostname', 'domain', 'firmware', 'dns-servers', 'networks', 'disks',
+                      'terraform_windows']
+
+    # Fields that reference data sources (or are not quoted), which must be the same for every team
+    FIXED_KEYS = ['id', 'datacenter', 'datastore', 'resource_pool', 'template', 'adapter', 'size', 'cpu', 'memory']
+
+    def __init__(self, host_id, entries):
+        self.host_id = host_id
+        self.entries = entries
+        self.host = None
+        self.values = {}
+        self.compactable = False
+
+        self._fold()
+
+    def _fold(self):
+        teams = [team['team'] for team, _ in self.entries]
+        hosts = [host for _, host in self.entries]
+
+        # Team names are the for_each keys
+        if len(set(teams)) != len(teams):
+            return
+
+        # Every team needs the exact same structure, and the same data sources
+        shape = self._shape(hosts[0])
+        if any(self._shape(x) != shape for x in hosts[1:]):
+            return
+
+        for field in self.FIXED_KEYS:
+            if any(x.get(field) != hosts[0].get(field) for x in hosts[1:]):
+                return
+
+        self.values = {team: {} for team in teams}
+        self.host = dict(hosts[0])
+
+        for field in self.VARYING_FIELDS:
+            if field not in self.host:
+                continue
+
+            folded = self._fold_value([x[field] for x in hosts], teams, [field])
+            if folded is None:
+                self.host = None
+                return
+
+            self.host[field] = folded
+
+        self.compactable = True
+
+    def _fold_value(self, values, teams, path):
+        first = values[0]
+
+        if isinstance(first, dict):
+            out = {}
+            for k in first:
+                out[k] = self._fold_value([x[k] for x in values], teams, path + [k])
+                if out[k] is None:
+                    return None
+
+            return out
+        elif isinstance(first, list):
+            out = []
+            for i in range(len(first)):
+                out.append(self._fold_value([x[i] for x in values], teams, path + [str(i)]))
+                if out[i] is None:
+                    return None
+
+            return out
+
+        if all(x == first for x in values[1:]):
+            return first
+
+        if not isinstance(first, str) or path[-1] in self.FIXED_KEYS:
+            return None
+
+        # IPs are split into address/netmask by the generators, so only the address can vary
+        if path[-1] == 'ip':
+            addresses = [x.split('/', 2) for x in values]
+            if any(len(x) != 2 or x[1] != addresses[0][1] for x in addresses):
+                return None
+
+            return '{}/{}'.format(self._add_values(path, teams, [x[0] for x in addresses]), addresses[0][1])
+
+        return self._add_values(path, teams, values)
+
+    def _add_values(self, path, teams, values):
+        key = re.sub('[^a-zA-Z0-9_]', '_', '_'.join(path))
+
+        for team, value in zip(teams, values):
+            self.values[team][key] = value
+
+        return '${{each.value.{}}}'.format(key)
+
+    def _shape(self, node, top=True):
+        if isinstance(node, dict):
+            # Only the fields the generators use matter
+            return {k: self._shape(v, False) for k, v in node.items()
+                    if not top or k in self.VARYING_FIELDS or k in self.FIXED_KEYS}
+        elif isinstance(node, list):
+            return [self._shape(x, False) for x in node]
+        elif isinstance(node, str):
+            return str
+
+        return node
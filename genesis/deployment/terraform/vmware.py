@@ -1,14 +1,83 @@
+import json
+import logging
+from collections import Counter
 from genesis.utils import hashid
 
 
 class VMwareGenerator(object):
+    EXTENSION = ''
+
+    # Terraform's own default
+    DEFAULT_PARALLELISM = 10
 
     def __init__(self, alias, platform, tf):
         self.alias = alias
         self.platform = platform
         self.tf = tf
 
-        self.configured = []
+        self.configured = set()
+        self.fp = None
+        self.logger = logging.getLogger(__name__)
+
+    def open(self, fp):
+        self.fp = fp
+        self.fp.write('\n'.join(self.tf.AUTOGENERATED_HEADER + [self.generate_provider()]))
+
+    def write_host(self, template, host, team):
+        self.fp.write('\n' + self.generate_host(template, host, team))
+
+    def write_blueprint(self, template, blueprint):
+        data = self._gen_data(template, blueprint.host)
+        data.append(self._gen_vm(blueprint.host, template, None, blueprint.values))
+
+        self.fp.write('\n' + '\n'.join(data))
+
+    def close(self):
+        self.fp = None
+
+    def parallelism(self, hosts):
+        """
+        Determines how many resources terraform may create at once on this platform. This is
+        calculated right before terraform runs, so it reflects the current vCenter load.
+        """
+        parallelism = self.platform.get('terraform_parallelism', self.DEFAULT_PARALLELISM)
+
+        # Caps per datastore only need the config. Terraform has a single parallelism for every
+        # resource, so it can only be multiplied when the hosts are spread evenly over the datastores.
+        if 'max_clones_per_datastore' in self.platform:
+            datastores = Counter([(x['datacenter'], x['datastore']) for x in hosts])
+            balanced = len(set(datastores.values())) <= 1
+
+            limit = self.platform['max_clones_per_datastore'] * (len(datastores) if balanced else 1)
+            parallelism = min(parallelism, limit)
+
+        # Everything else needs to be measured on vCenter
+        if 'max_queued_tasks' not in self.platform and 'max_clones_per_esxi_host' not in self.platform:
+            return parallelism
+
+        try:
+            si = self.platform.connect()
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.warning('Unable to measure vCenter load on %s, using parallelism of %d: %s',
+                                self.alias, parallelism, e)
+            return parallelism
+
+        if 'max_clones_per_esxi_host' in self.platform:
+            # Every clone could end up in the same resource pool, so the smallest one sets the limit
+            pools = {(x['datacenter'], x['resource_pool']) for x in hosts}
+            esxi_hosts = [self.platform.esxi_host_count(si, dc, pool) for dc, pool in pools]
+            esxi_hosts = [x for x in esxi_hosts if x > 0]
+
+            if esxi_hosts:
+                parallelism = min(parallelism, self.platform['max_clones_per_esxi_host'] * min(esxi_hosts))
+
+        if 'max_queued_tasks' in self.platform:
+            depth = self.platform.task_queue_depth(si)
+            self.logger.debug('vCenter %s currently has %d queued/running tasks', self.alias, depth)
+
+            parallelism = min(parallelism, self.platform['max_queued_tasks'] - depth)
+
+        return max(1, parallelism)
 
     def generate_provider(self):
         unverified_ssl = False
@@ -27,32 +96,40 @@ class VMwareGenerator(object):
         return '\n'.join(out)
 
     def generate_host(self, template, host, team):
+        data = self._gen_data(template, host)
+        data.append(self._gen_vm(host, template, team['team']))
+
+        return '\n'.join(data)
+
+    def _gen_data(self, template, host):
         data = []
 
-        if 'dc_{}'.format(host['datacenter']) not in self.configured:
+        if ('dc', host['datacenter']) not in self.configured:
             data.append(self._gen_datacenter(host['datacenter']))
-            self.configured.append('dc_{}'.format(host['datacenter']))
+            self.configured.add(('dc', host['datacenter']))
 
-        if 'ds_{}'.format(host['datastore']) not in self.configured:
+        if ('ds', host['datastore']) not in self.configured:
             data.append(self._gen_datastore(host['datastore'], host['datacenter']))
-            self.configured.append('ds_{}'.format(host['datastore']))
+            self.configured.add(('ds', host['datastore']))
 
-        if 'pool_{}'.format(host['resource_pool']) not in self.configured:
+        if ('pool', host['resource_pool']) not in self.configured:
             data.append(self._gen_pool(host['resource_pool'], host['datacenter']))
-            self.configured.append('pool_{}'.format(host['resource_pool']))
+            self.configured.add(('pool', host['resource_pool']))
 
-        if 'tpl_{}'.format(host['template']) not in self.configured:
+        if ('tpl', host['template']) not in self.configured:
             data.append(self._gen_template(template['id'], template['template'], host['datacenter']))
-            self.configured.append('tpl_{}'.format(host['template']))
+            self.configured.add(('tpl', host['template']))
 
         for net in host['networks']:
-            if 'net_{}'.format(net['adapter']) not in self.configured:
+            if ('net', net['adapter']) not in self.configured:
                 data.append(self._gen_network(net['adapter'], host['datacenter']))
-                self.configured.append('net_{}'.format(net['adapter']))
+                self.configured.add(('net', net['adapter']))
 
-        data.append(self._gen_vm(host, template, team['team']))
+        return data
 
-        return '\n'.join(data)
+    @staticmethod
+    def _quote(value):
+        return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
 
     def _gen_datacenter(self, name):
         return '\n'.join([
@@ -93,9 +170,22 @@ class VMwareGenerator(object):
             '}'
         ])
 
-    def _gen_vm(self, host, template, team):
-        out = [
-            'resource "vsphere_virtual_machine" "{}" {{'.format(hashid(host['name'] + team)),
+    def _gen_vm(self, host, template, team, for_each=None):
+        if for_each is None:
+            out = ['resource "vsphere_virtual_machine" "{}" {{'.format(hashid(host['name'] + team))]
+        else:
+            # One resource for every team
+            out = ['resource "vsphere_virtual_machine" "{}" {{'.format(hashid(host['id']))]
+            out.append('\tfor_each = {')
+
+            for key, values in for_each.items():
+                out.append('\t\t{} = {{'.format(self._quote(key)))
+                out += ['\t\t\t{} = {}'.format(k, self._quote(v)) for k, v in values.items()]
+                out.append('\t\t}')
+
+            out.append('\t}')
+
+        out += [
             '\tname = "{}"'.format(host['name']),
             '\tfolder = "{}"'.format(host['folder']),
             '\tresource_pool_id = "${{data.vsphere_resource_pool.{}.id}}"'.format(hashid(host['resource_pool'])),
@@ -202,3 +292,185 @@ class VMwareGenerator(object):
         out.append('}')
 
         return '\n'.join(out)
+
+
+class VMwareJSONGenerator(VMwareGenerator):
+    """
+    Generates Terraform's JSON syntax instead of HCL.
+
+    VMs are streamed straight to the file as they are generated. Only the (deduplicated)
+    data sources are kept around, and written once the file is closed.
+    """
+
+    EXTENSION = '.json'
+
+    def __init__(self, alias, platform, tf):
+        super().__init__(alias, platform, tf)
+
+        self.data_sources = {}
+        self.first_vm = True
+
+    def open(self, fp):
+        self.fp = fp
+        self.fp.write('{\n')
+        self.fp.write('"//": "WARNING: THIS FILE IS AUTOGENERATED. DO NOT EDIT MANUALLY",\n')
+        self.fp.write('"resource": {"vsphere_virtual_machine": {')
+
+    def write_host(self, template, host, team):
+        self._add_data_sources(template, host)
+        self._write_vm(hashid(host['name'] + team['team']), self._gen_vm_json(host, template))
+
+    def write_blueprint(self, template, blueprint):
+        self._add_data_sources(template, blueprint.host)
+
+        # One resource for every team
+        vm = {'for_each': blueprint.values}
+        vm.update(self._gen_vm_json(blueprint.host, template))
+        self._write_vm(hashid(blueprint.host['id']), vm)
+
+    def _add_data_sources(self, template, host):
+        self._add_data('vsphere_datacenter', host['datacenter'], {
+            'name': host['datacenter'],
+        })
+
+        for kind, name in [('vsphere_datastore', host['datastore']), ('vsphere_resource_pool', host['resource_pool'])]:
+            self._add_data(kind, name, {
+                'name': name,
+                'datacenter_id': self._ref('data.vsphere_datacenter', host['datacenter'], 'id'),
+            })
+
+        self._add_data('vsphere_virtual_machine', template['id'], {
+            'name': template['template'],
+            'datacenter_id': self._ref('data.vsphere_datacenter', host['datacenter'], 'id'),
+        })
+
+        for net in host['networks']:
+            self._add_data('vsphere_network', net['adapter'], {
+                'name': net['adapter'],
+                'datacenter_id': self._ref('data.vsphere_datacenter', host['datacenter'], 'id'),
+            })
+
+    def _write_vm(self, resource_id, vm):
+        # Stream out the VM
+        if not self.first_vm:
+            self.fp.write(',')
+
+        self.fp.write('\n{}: {}'.format(json.dumps(resource_id), json.dumps(vm)))
+        self.first_vm = False
+
+    def close(self):
+        if self.fp is None:
+            return
+
+        provider = {
+            'user': self.platform['user'],
+            'password': self.platform['pass'],
+            'vsphere_server': self.platform['host'],
+            'allow_unverified_ssl': bool(self.platform.get('allow_unverified_ssl', False)),
+        }
+
+        self.fp.write('\n}}}},\n"data": {},\n"provider": {}\n}}\n'.format(
+            json.dumps(self.data_sources, indent=1), json.dumps({'vsphere': provider}, indent=1)))
+        self.fp = None
+
+    def _add_data(self, kind, name, body):
+        if (kind, name) in self.configured:
+            return
+
+        self.data_sources.setdefault(kind, {})[hashid(name)] = body
+        self.configured.add((kind, name))
+
+    @staticmethod
+    def _ref(kind, name, attribute):
+        return '${{{}.{}.{}}}'.format(kind, hashid(name), attribute)
+
+    def _gen_vm_json(self, host, template):
+        tpl_ref = 'data.vsphere_virtual_machine'
+
+        out = {
+            'name': host['name'],
+            'folder': host['folder'],
+            'resource_pool_id': self._ref('data.vsphere_resource_pool', host['resource_pool'], 'id'),
+            'datastore_id': self._ref('data.vsphere_datastore', host['datastore'], 'id'),
+            'num_cpus': host['cpu'],
+            'memory': host['memory'],
+            'guest_id': self._ref(tpl_ref, host['template'], 'guest_id'),
+            'scsi_type': self._ref(tpl_ref, host['template'], 'scsi_type'),
+        }
+
+        if 'firmware' in host:
+            out['firmware'] = host['firmware']
+
+        # If the machine requires custom post provisioning, disable waiting for a network
+        if template['os'] in self.tf.CUSTOM_POST_PROVISION_HOSTS:
+            out['wait_for_guest_net_routable'] = False
+
+        # Networks
+        out['network_interface'] = [{
+            'network_id': self._ref('data.vsphere_network', net['adapter'], 'id'),
+            'adapter_type': self._ref(tpl_ref, host['template'], 'network_interface_types[0]'),
+        } for net in host['networks']]
+
+        # Disks
+        out['disk'] = []
+        for disk in host['disks']:
+            out['disk'].append({
+                'label': disk['label'],
+                'size': disk['size'] if 'size' in disk else self._ref(tpl_ref, host['template'], 'disks.0.size'),
+                'thin_provisioned': self._ref(tpl_ref, host['template'], 'disks.0.thin_provisioned'),
+            })
+
+        # Clone (with a 1 hour timeout)
+        out['clone'] = {
+            'template_uuid': self._ref(tpl_ref, host['template'], 'id'),
+            'timeout': 60,
+        }
+
+        # Customize Section
+        if template['os'] in self.tf.CAN_CUSTOMIZE_OS:
+            # Set customization timeout to be 45 minutes
+            customize = {
+                'timeout': 45,
+            }
+
+            # linux_options, with DNS (which needs to be 'global' on linux)
+            if template['os'] in self.tf.LINUX_OS:
+                customize['linux_options'] = {
+                    'host_name': host['hostname'],
+                    'domain': host['domain'],
+                }
+                customize['dns_server_list'] = host['dns-servers']
+                customize['dns_suffix_list'] = [host['domain']]
+
+            # windows_options
+            if template['os'] in self.tf.WINDOWS_OS:
+                customize['windows_options'] = {
+                    'computer_name': host['hostname'],
+                    'organization_name': 'genesis',
+                }
+                customize['windows_options'].update(host.get('terraform_windows', {}))
+
+            # network_interface
+            gateway = None
+            customize['network_interface'] = []
+            for net in host['networks']:
+                ipaddr, netmask = net['ip'].split('/', 2)
+                interface = {
+                    'ipv4_address': ipaddr,
+                    'ipv4_netmask': int(netmask),
+                }
+
+                # DNS for Windows
+                if template['os'] in self.tf.WINDOWS_OS:
+                    interface['dns_server_list'] = host['dns-servers']
+                    interface['dns_domain'] = host['domain']
+
+                customize['network_interface'].append(interface)
+
+                if gateway is None or (gateway is not None and net.get('primary', False)):
+                    gateway = net['gateway']
+
+            customize['ipv4_gateway'] = gateway
+            out['clone']['customize'] = customize
+
+        return out
@@ -121,10 +121,35 @@ class SetupCLIEnviron(BaseDeployer):
     NAME = "SetupCLIEnviron"
     DESC = "Sets up the CLI environ for deploys"
 
+    TERRAFORM_PLUGIN_CACHE = '.terraform-plugin-cache'
+
+    SCHEMA = {
+        'terraform_plugin_mirror': {
+            'type': 'string',
+        },
+    }
+
     def generate(self, data):
         data['cli_environ'] = dict(os.environ)
         data['cli_environ']['ANSIBLE_NOCOWS'] = '1'
         data['cli_environ']['ANSIBLE_ROLES_PATH'] = data['roles_dir']
 
+        # Share terraform providers between every step, so they are only downloaded once. Terraform runs
+        # from the step folders, so the path must not be relative to the current directory.
+        plugin_cache = os.path.abspath("{}/{}".format(self.args.output, self.TERRAFORM_PLUGIN_CACHE))
+        if not os.path.exists(plugin_cache):
+            self.logger.debug('Creating terraform plugin cache: %s', plugin_cache)
+            os.makedirs(plugin_cache, exist_ok=True)
+
+        data['cli_environ']['TF_PLUGIN_CACHE_DIR'] = plugin_cache
+        data['cli_environ']['TF_IN_AUTOMATION'] = '1'
+
+        # Local provider mirror (eg: for air-gapped networks), relative to the config file
+        data['terraform_plugin_mirror'] = None
+        if 'terraform_plugin_mirror' in self.config:
+            config_dir = os.path.dirname(os.path.realpath(self.args.config.name))
+            data['terraform_plugin_mirror'] = os.path.join(config_dir,
+                                                           os.path.expanduser(self.config['terraform_plugin_mirror']))
+
     def execute(self, data):
         return []
@@ -1,5 +1,5 @@
 import logging
-from pyVim import connect
+from concurrent.futures import ThreadPoolExecutor
 from pyVmomi import vim, vmodl #pylint: disable=no-name-in-module
 from genesis.deployment import BaseDeployer
 
@@ -9,6 +9,9 @@ class VMwareNetworkFixer(BaseDeployer):
     NAME = "VMwareNetworkFixer"
     DESC = "Meta deployer that ensures VMs deployed from VMware have NICs attached"
 
+    # Reconfigure tasks in flight per platform, unless the platform sets max_queued_tasks
+    RECONFIGURE_WINDOW = 20
+
     def __init__(self, step, config, args, deploy):
         super().__init__(step, config, args, deploy)
 
@@ -16,14 +19,11 @@ class VMwareNetworkFixer(BaseDeployer):
         self.platforms = config['platforms']
 
     def generate(self, data):
-        # Determine which hosts utilize vmware
-        vmware_hosts = []
-        for host in self.deploy.deploy_hosts:
-            template = self.deploy.templates[host['template']]
-            platform = self.platforms[template['virt_platform']]
-
-            if platform['type'] == 'vmware':
-                vmware_hosts.append(host['id'])
+        # Determine which platforms (and their hosts) utilize vmware
+        vmware_hosts = {}
+        for platform_name, hosts in self.deploy.hosts_by_platform.items():
+            if self.platforms[platform_name]['type'] == 'vmware':
+                vmware_hosts[platform_name] = hosts
 
         # Save this to the deployment data
         data['vmware_network_fixer_hosts'] = vmware_hosts
@@ -35,95 +35,209 @@ class VMwareNetworkFixer(BaseDeployer):
 
         # Build a list of VMs we need to get status on
         vms = {}
-        for host in self.deploy.flat_deploy:
-            if host['id'] not in data['vmware_network_fixer_hosts']:
+        for platform_name, hosts in data['vmware_network_fixer_hosts'].items():
+            vms[platform_name] = ["{datacenter}/vm/{folder}/{name}".format(**host) for host in hosts]
+
+        # Ensure NICs are enabled on all VMs, one worker per vSphere instance
+        with ThreadPoolExecutor(max_workers=len(vms)) as executor:
+            results = list(executor.map(self._fix_platform, vms.keys(), vms.values()))
+
+        failures = [failure for result, _ in results for failure in result]
+        platform_failures = [(name, error) for name, (_, error) in zip(vms.keys(), results) if error is not None]
+
+        for host, error in failures:
+            self.logger.critical('Failed to fix the NICs of %s: %s', host, error)
+
+        for name, error in platform_failures:
+            self.logger.critical('Failed to fix the NICs on platform %s: %s', name, error)
+
+        failed = []
+        if failures:
+            failed.append('{} VMs ({})'.format(len(failures), ', '.join([x[0] for x in failures])))
+        if platform_failures:
+            failed.append('{} platforms ({})'.format(len(platform_failures),
+                                                     ', '.join([x[0] for x in platform_failures])))
+
+        if failed:
+            raise Exception('{} failed on {}'.format(self.NAME, ' and '.join(failed)))
+
+        return []
+
+    def _fix_platform(self, platform_name, hosts):
+        """
+        Fixes the NICs of every VM on one platform, returning the (host, error) of every VM that failed,
+        and the error of the platform itself (eg: when vCenter is unreachable)
+        """
+        try:
+            return self._fix_vms(platform_name, hosts), None
+        except Exception as e:  # pylint: disable=broad-except
+            return [], e
+
+    def _fix_vms(self, platform_name, hosts):
+        # Grab the platform config
+        platform = self.platforms[platform_name]
+
+        # Grab the (shared) VMware connection
+        si = platform.connect()
+
+        # Grab every VM (and its devices) at once
+        found = self._find_vms(si, hosts)
+
+        # Figure out which VMs need to be modified
+        failures = []
+        changes = []
+        for host in hosts:
+            # This should not happen
+            if host not in found:
+                self.logger.error('Unable to find VM: %s (this should not happen)', host)
+                failures.append((host, 'VM not found'))
                 continue
 
-            template = self.deploy.templates[host['template']]
-            platform_name = template['virt_platform']
-            platform_vms = vms.get(platform_name, [])
+            vm, devices = found[host]
+            spec = self._nic_spec(devices)
 
-            platform_vms.append("{datacenter}/vm/{folder}/{name}".format(**host))
-            vms[platform_name] = platform_vms
+            if spec is not None:
+                self.logger.info('The following VM required NIC changes: %s', host)
+                changes.append((host, vm, spec))
+
+        # Reconfigure them, without flooding the task queue
+        if changes:
+            window = platform.get('max_queued_tasks') or self.RECONFIGURE_WINDOW
+            self.logger.debug('Reconfiguring %d VMs on %s (%d at once)', len(changes), platform_name, window)
+
+            for host, error in self._run_tasks(si, changes, window):
+                if error is None:
+                    self.logger.debug('Fixed the NICs of %s', host)
+                else:
+                    failures.append((host, error))
+
+        return failures
+
+    @staticmethod
+    def _nic_spec(devices):
+        # Figure out NIC status
+        dev_changes = []
+        for dev in devices:
+            if not isinstance(dev, vim.vm.device.VirtualEthernetCard):
+                continue
 
-        # Ensure NICs are enabled on all VMs
-        for platform_name, hosts in vms.items():
-            # Grab the platform config
-            platform = self.platforms[platform_name]
+            virtual_nic_spec = vim.vm.device.VirtualDeviceSpec()
+            virtual_nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+            virtual_nic_spec.device = dev
+            virtual_nic_spec.device.key = dev.key
+            virtual_nic_spec.device.macAddress = dev.macAddress
+            virtual_nic_spec.device.backing = dev.backing
+            virtual_nic_spec.device.wakeOnLanEnabled = dev.wakeOnLanEnabled
 
-            # Create a VMware connection
-            method = connect.SmartConnect
-            if 'allow_unverified_ssl' in platform and platform['allow_unverified_ssl']:
-                method = connect.SmartConnectNoSSL
+            # Connect things, if needed
+            connectable = dev.connectable
+            changed = False
+            if not dev.connectable.startConnected:
+                connectable.startConnected = True
+                changed = True
 
-            self.logger.debug('Connecting to vSphere instance: %s', platform['host'])
-            si = method(host=platform['host'],
-                        user=platform['user'],
-                        pwd=platform['pass'])
+            if not dev.connectable.connected and dev.connectable.status == 'ok':
+                connectable.connected = True
+                changed = True
 
-            # Modify NICs if required
-            tasks = []
-            for host in hosts:
-                vm = si.content.searchIndex.FindByInventoryPath(host)
+            virtual_nic_spec.device.connectable = connectable
 
-                # This should not happen
-                if vm is None:
-                    self.logger.error('Unable to find VM: %s (this should not happen)', host)
-                    continue
+            if changed:
+                dev_changes.append(virtual_nic_spec)
 
-                # Figure out NIC status
-                dev_changes = []
-                for dev in vm.config.hardware.device:
-                    if not isinstance(dev, vim.vm.device.VirtualEthernetCard):
-                        continue
+        if not dev_changes:
+            return None
 
-                    virtual_nic_spec = vim.vm.device.VirtualDeviceSpec()
-                    virtual_nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-                    virtual_nic_spec.device = dev
-                    virtual_nic_spec.device.key = dev.key
-                    virtual_nic_spec.device.macAddress = dev.macAddress
-                    virtual_nic_spec.device.backing = dev.backing
-                    virtual_nic_spec.device.wakeOnLanEnabled = dev.wakeOnLanEnabled
+        spec = vim.vm.ConfigSpec()
+        spec.deviceChange = dev_changes
+        return spec
 
-                    # Connect things, if needed
-                    connectable = dev.connectable
-                    changed = False
-                    if not dev.connectable.startConnected:
-                        connectable.startConnected = True
-                        changed = True
+    def _find_vms(self, si, paths):
+        """
+        Finds VMs by inventory path, along with their devices, in two property retrievals
+        (instead of a search and several lazy property fetches per VM)
+        """
+        paths = set(paths)
 
-                    if not dev.connectable.connected and dev.connectable.status == 'ok':
-                        connectable.connected = True
-                        changed = True
+        # Pass 1: Names and parents of everything that makes up an inventory path
+        inventory = self._retrieve(si, [vim.VirtualMachine, vim.Folder, vim.Datacenter], ['name', 'parent'])
+        objects = {}
+        for obj in inventory:
+            props = {x.name: x.val for x in obj.propSet}
+            objects[str(obj.obj)] = (obj.obj, props.get('name'), props.get('parent'))
 
-                    virtual_nic_spec.device.connectable = connectable
+        vms = {}
+        for ref, (obj, name, parent) in objects.items():
+            if not isinstance(obj, vim.VirtualMachine):
+                continue
 
-                    if changed:
-                        dev_changes.append(virtual_nic_spec)
+            # Walk up to (but not including) the root folder
+            parts = [name]
+            while parent is not None and str(parent) in objects:
+                _, parent_name, grandparent = objects[str(parent)]
+                if grandparent is None:
+                    break
+
+                parts.insert(0, parent_name)
+                parent = grandparent
+
+            path = '/'.join(parts)
+            if path in paths:
+                vms[ref] = path
+
+        if not vms:
+            return {}
+
+        # Pass 2: Devices of the VMs we care about
+        found = {}
+        for obj in self._retrieve(si, [vim.VirtualMachine], ['config.hardware.device'],
+                                  [objects[x][0] for x in vms]):
+            devices = [x.val for x in obj.propSet if x.name == 'config.hardware.device']
+            found[vms[str(obj.obj)]] = (obj.obj, devices[0] if devices else [])
+
+        return found
+
+    @staticmethod
+    def _retrieve(si, types, path_set, objs=None):
+        content = si.content
+        pc = vmodl.query.PropertyCollector
+        view = None
+
+        if objs is None:
+            # Everything in the inventory, through a container view
+            view = content.viewManager.CreateContainerView(content.rootFolder, types, True)
+            traversal = pc.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+            obj_specs = [pc.ObjectSpec(obj=view, skip=True, selectSet=[traversal])]
+        else:
+            obj_specs = [pc.ObjectSpec(obj=x) for x in objs]
+
+        filter_spec = pc.FilterSpec(objectSet=obj_specs,
+                                    propSet=[pc.PropertySpec(type=x, pathSet=path_set) for x in types])
 
-                if not dev_changes:
-                    continue
+        try:
+            objects = []
+            result = content.propertyCollector.RetrievePropertiesEx([filter_spec], pc.RetrieveOptions())
 
-                self.logger.info('The following VM required NIC changes: %s', host)
-                spec = vim.vm.ConfigSpec()
-                spec.deviceChange = dev_changes
-                tasks.append(vm.ReconfigVM_Task(spec=spec))
+            # Results are paged
+            while result is not None:
+                objects += result.objects
 
-            # Wait for the tasks to complete
-            if tasks:
-                self.logger.debug('Waiting for %d tasks to complete', len(tasks))
-                self._wait_for_tasks(si, tasks)
-                self.logger.debug('Tasks completed!')
+                if not result.token:
+                    break
 
-            # We're done
-            self.logger.debug('Disconnecting from: %s', platform['host'])
-            connect.Disconnect(si)
+                result = content.propertyCollector.ContinueRetrievePropertiesEx(result.token)
 
-        return []
+            return objects
+        finally:
+            if view is not None:
+                view.Destroy()
 
-    def _wait_for_tasks(self, si, tasks):
+    def _run_tasks(self, si, changes, window):
         """
-        Source: https://github.com/vmware/pyvmomi-community-samples/blob/master/samples/tools/tasks.py
+        Submits a ReconfigVM_Task for every (host, vm, spec), keeping at most `window` of them in flight,
+        and yields (host, error) as they finish. The error is None if the task succeeded.
+
+        Based on: https://github.com/vmware/pyvmomi-community-samples/blob/master/samples/tools/tasks.py
 
         Written by Michael Rice <michael@michaelrice.org>
         Github: https://github.com/michaelrice
@@ -133,40 +247,57 @@ class VMwareNetworkFixer(BaseDeployer):
         http://www.apache.org/licenses/LICENSE-2.0.html
         """
         property_collector = si.content.propertyCollector
-        task_list = [str(task) for task in tasks]
-        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task) for task in tasks]
-        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=[], all=True)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state'])
 
-        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-        filter_spec.objectSet = obj_specs
-        filter_spec.propSet = [property_spec]
-        pcfilter = property_collector.CreateFilter(filter_spec, True)
+        pending = list(changes)
+        in_flight = {}
 
         try:
-            version, state = None, None
+            version = None
+
+            while pending or in_flight:
+                # Top up the window
+                while pending and len(in_flight) < window:
+                    host, vm, spec = pending.pop(0)
+
+                    try:
+                        task = vm.ReconfigVM_Task(spec=spec)
+                    except vmodl.MethodFault as error:
+                        yield host, error.msg
+                        continue
+
+                    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+                        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=task)], propSet=[property_spec])
+                    in_flight[str(task)] = (host, task, property_collector.CreateFilter(filter_spec, True))
+
+                if not in_flight:
+                    continue
 
-            while task_list:
                 update = property_collector.WaitForUpdates(version)
                 for filter_set in update.filterSet:
                     for obj_set in filter_set.objectSet:
                         task = obj_set.obj
+                        if str(task) not in in_flight:
+                            continue
+
                         for change in obj_set.changeSet:
-                            if change.name == 'info':
-                                state = change.val.state
-                            elif change.name == 'info.state':
-                                state = change.val
-                            else:
+                            if change.name != 'info.state':
                                 continue
 
-                            if not str(task) in task_list:
+                            if change.val not in [vim.TaskInfo.State.success, vim.TaskInfo.State.error]:
                                 continue
 
-                            if state == vim.TaskInfo.State.success:
-                                task_list.remove(str(task))
-                            elif state == vim.TaskInfo.State.error:
-                                raise task.info.error
+                            host, _, pcfilter = in_flight.pop(str(task))
+                            pcfilter.Destroy()
+
+                            if change.val == vim.TaskInfo.State.success:
+                                yield host, None
+                            else:
+                                yield host, task.info.error.msg
+
+                            break
 
                 version = update.version
         finally:
-            if pcfilter:
+            for _, _, pcfilter in in_flight.values():
                 pcfilter.Destroy()
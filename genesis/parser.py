@@ -1,11 +1,11 @@
 from abc import abstractmethod
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
 import yaml
 import genesis.utils as utils
 
 
 class Parser(object):
-    TOKEN_CALC = "!calc"
-
     def __init__(self, args):
         self.args = args
         self.data = {}
@@ -19,51 +19,165 @@ class Parser(object):
     def parse(self):
         tpl = self.data['teams_template']
         hosts = []
-        teams = []
 
         for host_config in self.data['hosts']:
             host = self.data['hosts_defaults'].copy()
             host.update(host_config)
             hosts.append(host)
 
-        self.data['hosts'] = hosts
+        expander = TeamExpander(tpl, hosts)
+        start = self.args.start_team_number
+        stop = self.args.start_team_number + self.args.teams
+
+        # Teams are expanded on demand, unless we were asked to expand them up front in parallel
+        teams = Teams(expander, start, self.args.teams)
+        if self.args.parse_workers > 1:
+            teams.preload(self._parse_parallel(expander, start, stop))
+        else:
+            # Hosts are only rendered when deploying, but errors in the variables must surface now
+            for x in range(start, stop):
+                expander.check(x)
+
+        # We replace the first 'host' so it has actual values. This is mostly for the
+        # validators
+        if teams:
+            self.data['hosts'] = expander.expand_hosts(start)
+
+        self.data['teams'] = teams
+        del self.data['teams_template']
+        del self.data['hosts_defaults']
+
+        return self.data
+
+    def _parse_parallel(self, expander, start, stop):
+        workers = self.args.parse_workers
+
+        # Split the teams into one contiguous range per worker
+        chunk_size = max(1, -(-(stop - start) // workers))
+        ranges = [(x, min(x + chunk_size, stop)) for x in range(start, stop, chunk_size)]
+
+        teams = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() returns results in submission order, so teams stay in order
+            for chunk in executor.map(_expand_range, [expander] * len(ranges), ranges):
+                teams += chunk
+
+        return teams
+
+
+class Teams(Sequence):
+    """
+    Indexed, on-demand view of the expanded teams.
+
+    Teams are only rendered when they are accessed, and expand() can restrict the
+    rendering to the hosts a deployment step actually needs. Nothing is kept around
+    afterwards, unless the teams were preloaded (eg: by --parse-workers).
+    """
+
+    def __init__(self, expander, start, count):
+        self.expander = expander
+        self.start = start
+        self.count = count
+        self.preloaded = None
+
+    def __len__(self):
+        return self.count
 
-        first_host_replaced = False
-        for x in range(self.args.start_team_number, self.args.start_team_number + self.args.teams):
-            replace_tpl = tpl['variables'].copy()
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(self.count))]
 
-            # Default variables
-            replace_tpl['team'] = '{team}'
-            replace_tpl['team_pad'] = '0{team}' if x < 10 else '{team}'
+        return self.expand(index)
 
-            # Initial replacement
-            replace_tpl = utils.recursive_replace(replace_tpl, {'team': x, 'team_pad': '{:02d}'.format(x)}, x - 1)
+    def expand(self, index, host_ids=None):
+        if index < 0:
+            index += self.count
 
-            # Interactive replacements
-            # Calculations
-            for k, v in replace_tpl.items():
-                if v[:len(self.TOKEN_CALC)] != self.TOKEN_CALC:
-                    continue
+        if not 0 <= index < self.count:
+            raise IndexError('team index out of range')
 
-                replace_tpl[k] = utils.calculator_eval(v[len(self.TOKEN_CALC):])
+        if self.preloaded is not None:
+            team = self.preloaded[index]
+            if host_ids is None:
+                return team
 
-            team = {
-                'team': utils.recursive_replace(tpl['name'], replace_tpl, x - 1),
-                'hosts': utils.recursive_replace(hosts, replace_tpl, x - 1)
+            return {
+                'team': team['team'],
+                'hosts': [x for x in team['hosts'] if x['id'] in host_ids]
             }
 
-            # We replace the first 'host' so it has actual values. This is mostly for the
-            # validators
-            if not first_host_replaced:
-                self.data['hosts'] = utils.recursive_replace(hosts, replace_tpl, x - 1)
+        return self.expander.expand(self.start + index, host_ids)
 
-            teams.append(team)
+    def preload(self, teams):
+        self.preloaded = teams
 
-        self.data['teams'] = teams
-        del self.data['teams_template']
-        del self.data['hosts_defaults']
 
-        return self.data
+class TeamExpander(object):
+    TOKEN_CALC = "!calc"
+
+    def __init__(self, tpl, hosts):
+        # Split out the calculations, so they are only compiled once
+        variables = {}
+        self.calculations = {}
+        self.variable_order = list(tpl['variables'])
+
+        for k, v in tpl['variables'].items():
+            if isinstance(v, str) and v[:len(self.TOKEN_CALC)] == self.TOKEN_CALC:
+                self.calculations[k] = utils.compile_calc(v[len(self.TOKEN_CALC):])
+            else:
+                variables[k] = v
+
+        # Compile everything that gets rendered per team once
+        self.variables_tpl = utils.Template(variables)
+        self.name_tpl = utils.Template(tpl['name'])
+        self.hosts_tpl = [(host.get('id'), utils.Template(host)) for host in hosts]
+
+    def expand_range(self, start, stop):
+        return [self.expand(x) for x in range(start, stop)]
+
+    def expand(self, x, host_ids=None):
+        replace_tpl = self.variables(x)
+
+        return {
+            'team': self.name_tpl.render(replace_tpl, x - 1),
+            'hosts': self._render_hosts(replace_tpl, x, host_ids)
+        }
+
+    def check(self, x):
+        """
+        Evaluates the variables and calculations of a team (without rendering its hosts),
+        raising the same errors expanding the team would
+        """
+        # Rendering the name unpacks every variable
+        self.name_tpl.render(self.variables(x), x - 1)
+
+    def expand_hosts(self, x):
+        return self._render_hosts(self.variables(x), x)
+
+    def _render_hosts(self, replace_tpl, x, host_ids=None):
+        return [tpl.render(replace_tpl, x - 1)
+                for hid, tpl in self.hosts_tpl if host_ids is None or hid in host_ids]
+
+    def variables(self, x):
+        defaults = {'team': x, 'team_pad': '{:02d}'.format(x)}
+
+        # Initial replacement, with the default variables
+        rendered = self.variables_tpl.render(defaults, x - 1)
+
+        # Interactive replacements
+        # Calculations
+        for k, calc in self.calculations.items():
+            rendered[k] = calc.evaluate(defaults)
+
+        replace_tpl = {k: rendered[k] for k in self.variable_order}
+        replace_tpl['team'] = str(x)
+        replace_tpl['team_pad'] = '{:02d}'.format(x)
+
+        return replace_tpl
+
+
+def _expand_range(expander, team_range):
+    return expander.expand_range(*team_range)
 
 
 class YamlParser(Parser):
@@ -10,17 +10,33 @@ class BasePlatform(UserDict):
     # Steps to run through the validator
     VALID_STEPS = ['_validate_config', '_validate_connection']
 
-    def __init__(self, provider, disable_platform_check):
+    # Whether a successful connection check can be cached (see check_key)
+    CACHE_CHECKS = False
+
+    def __init__(self, provider, disable_platform_check, check_cache=None):
         super().__init__()
 
         self.data = provider
         self.disable_platform_check = disable_platform_check
+        self.check_cache = check_cache
 
         if self.SCHEMA is not None:
             self.validator = Validator(self.SCHEMA, allow_unknown=True)
 
     def validate(self):
+        cacheable = self.CACHE_CHECKS and self.check_cache is not None and not self.disable_platform_check
+        key = self.check_key() if cacheable else None
+        fingerprint = self.check_cache.fingerprint(self.data) if cacheable else None
+        checked = False
+
         for step in self.VALID_STEPS:
+            # Skip connecting if this exact config was verified recently
+            if step == '_validate_connection' and cacheable:
+                if self.check_cache.is_fresh(key, fingerprint):
+                    continue
+
+                checked = True
+
             fn = getattr(self, step)
 
             valid, errors = fn()
@@ -28,8 +44,18 @@ class BasePlatform(UserDict):
             if not valid:
                 return valid, errors
 
+        # Only a check that actually ran restarts the TTL
+        if checked:
+            self.check_cache.record(key, fingerprint)
+
         return True, []
 
+    def check_key(self):
+        """
+        Key of this platform in the platform check cache
+        """
+        return "{}://{}".format(self.NAME, self.data.get('host', ''))
+
     def _validate_config(self):
         if self.SCHEMA is None:
             return True, []
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class PlatformCheckCache(object):
+    """
+    Remembers which platforms passed verification recently, so repeated runs do not have
+    to log in to every platform again.
+
+    Entries are keyed by platform, and hold a fingerprint of the platform's config (which
+    includes its credentials). A platform is only trusted while its entry is younger than
+    the TTL and the fingerprint still matches.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+        if os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self.entries = json.load(fp)
+            except ValueError:
+                self.logger.warning('Ignoring invalid platform check cache: %s', path)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(config):
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def is_fresh(self, key, fingerprint):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+
+        return time.time() - entry['verified'] < self.ttl
+
+    def record(self, key, fingerprint):
+        with self.lock:
+            self.entries[key] = {
+                'fingerprint': fingerprint,
+                'verified': time.time(),
+            }
+
+            # Write atomically, and only readable by us (the fingerprints are derived from credentials)
+            tmp = "{}.tmp".format(self.path)
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+                json.dump(self.entries, fp, indent=2, sort_keys=True)
+
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
@@ -1,13 +1,114 @@
+import atexit
 import logging
+import threading
+import time
+from collections import defaultdict
 from pyVim import connect
-from pyVmomi import vmodl  # pylint: disable=no-name-in-module
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
 from genesis.platforms.base import BasePlatform
+from genesis.utils import hashid
+
+
+class VMwareSessionPool(object):
+    """
+    Process-wide pool of vSphere sessions, one per vSphere instance and set of credentials.
+
+    Logging in is one of the slowest vCenter calls (and vCenter limits the amount of sessions),
+    so platform validation and every deployer share the same session. Idle sessions are kept
+    alive in the background, and sessions that expired anyway are re-authenticated on use.
+    """
+
+    # Seconds between keepalives, vCenter expires idle sessions after 30 minutes by default
+    KEEPALIVE_INTERVAL = 300
+
+    # Seconds a session is trusted without checking it is still authenticated
+    CHECK_INTERVAL = 60
+
+    SESSIONS = {}
+    LOCKS = defaultdict(threading.Lock)
+    LOCK = threading.Lock()
+    KEEPALIVE = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    def get(self, key, login):
+        """
+        Returns the session for `key`, calling `login` to create it if there is none (or it expired)
+        """
+        with self.LOCK:
+            lock = self.LOCKS[key]
+
+        # One login per key, while other keys can log in at the same time
+        with lock:
+            if key in self.SESSIONS:
+                si, checked = self.SESSIONS[key]
+                if time.monotonic() - checked < self.CHECK_INTERVAL or self._alive(si):
+                    self.SESSIONS[key] = (si, time.monotonic())
+                    return si
+
+                self.logger.debug('vSphere session for %s@%s expired, re-authenticating', key[1], key[0])
+
+            si = login()
+            self.SESSIONS[key] = (si, time.monotonic())
+
+        self._start_keepalive()
+        return si
+
+    def close(self):
+        with self.LOCK:
+            sessions = list(self.SESSIONS.items())
+            self.SESSIONS.clear()
+
+        for key, (si, _) in sessions:
+            self.logger.debug('Disconnecting from vSphere instance: %s', key[0])
+
+            try:
+                connect.Disconnect(si)
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def _start_keepalive(self):
+        with self.LOCK:
+            if VMwareSessionPool.KEEPALIVE is not None:
+                return
+
+            VMwareSessionPool.KEEPALIVE = threading.Thread(target=self._keepalive, name='vsphere-keepalive',
+                                                           daemon=True)
+            VMwareSessionPool.KEEPALIVE.start()
+
+        atexit.register(self.close)
+
+    def _keepalive(self):
+        while True:
+            time.sleep(self.KEEPALIVE_INTERVAL)
+
+            with self.LOCK:
+                sessions = list(self.SESSIONS.items())
+
+            for key, (si, _) in sessions:
+                # Expired sessions are re-authenticated on their next use
+                if not self._alive(si):
+                    continue
+
+                with self.LOCK:
+                    if key in self.SESSIONS and self.SESSIONS[key][0] is si:
+                        self.SESSIONS[key] = (si, time.monotonic())
+
+    @staticmethod
+    def _alive(si):
+        try:
+            return si.content.sessionManager.currentSession is not None
+        except Exception:  # pylint: disable=broad-except
+            return False
 
 
 class VMwarePlatform(BasePlatform):
 
     NAME = "vmware"
 
+    CACHE_CHECKS = True
+
     SCHEMA = {
         'host': {
             'type': 'string',
@@ -24,32 +125,93 @@ class VMwarePlatform(BasePlatform):
         'allow_unverified_ssl': {
             'type': 'boolean',
         },
+        'terraform_parallelism': {
+            'type': 'integer',
+            'min': 1,
+        },
+        'max_queued_tasks': {
+            'type': 'integer',
+            'min': 1,
+        },
+        'max_clones_per_esxi_host': {
+            'type': 'integer',
+            'min': 1,
+        },
+        'max_clones_per_datastore': {
+            'type': 'integer',
+            'min': 1,
+        },
     }
 
-    def __init__(self, provider, disable_platform_check):
-        super().__init__(provider, disable_platform_check)
+    def __init__(self, provider, disable_platform_check, check_cache=None):
+        super().__init__(provider, disable_platform_check, check_cache)
 
         self.logger = logging.getLogger(__name__)
 
-    def _validate_connection(self):
-        if self.disable_platform_check:
-            self.logger.debug('Disabling platform check for: %s', self.data['host'])
-            return True, []
+    def check_key(self):
+        return "{}://{}@{}".format(self.NAME, self.data['user'], self.data['host'])
+
+    def connect(self):
+        """
+        Returns a (shared) session to the vSphere instance. It must not be disconnected,
+        the session pool does that on exit.
+        """
+        # Anything that changes how we log in gets its own session
+        key = (self.data['host'], self.data['user'], hashid(self.data['pass']),
+               bool(self.data.get('allow_unverified_ssl', False)))
+        return VMwareSessionPool().get(key, self._login)
 
+    def _login(self):
         method = connect.SmartConnect
         if 'allow_unverified_ssl' in self.data and self.data['allow_unverified_ssl']:
             method = connect.SmartConnectNoSSL
 
+        self.logger.debug('Connecting to vSphere instance: %s', self.data['host'])
+        return method(host=self.data['host'],
+                      user=self.data['user'],
+                      pwd=self.data['pass'])
+
+    def task_queue_depth(self, si):
+        """
+        Returns the number of queued or running tasks on the vSphere instance,
+        using one property retrieval for all of the recent tasks
+        """
+        tasks = si.content.taskManager.recentTask
+        if not tasks:
+            return 0
+
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task) for task in tasks]
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[property_spec])
+
+        depth = 0
+        for obj in si.content.propertyCollector.RetrieveContents([filter_spec]):
+            for prop in obj.propSet:
+                if prop.val in [vim.TaskInfo.State.queued, vim.TaskInfo.State.running]:
+                    depth += 1
+
+        return depth
+
+    def esxi_host_count(self, si, datacenter, resource_pool):
+        """
+        Returns the number of connected ESXi hosts (not in maintenance) backing a resource pool
+        """
+        pool = si.content.searchIndex.FindByInventoryPath("{}/host/{}".format(datacenter, resource_pool))
+        if pool is None or not isinstance(pool, vim.ResourcePool):
+            return 0
+
+        return len([x for x in pool.owner.host
+                    if x.runtime.connectionState == 'connected' and not x.runtime.inMaintenanceMode])
+
+    def _validate_connection(self):
+        if self.disable_platform_check:
+            self.logger.debug('Disabling platform check for: %s', self.data['host'])
+            return True, []
+
         try:
-            # Connect
-            self.logger.debug('Connecting to vSphere instance: %s', self.data['host'])
-            service_instance = method(host=self.data['host'],
-                                      user=self.data['user'],
-                                      pwd=self.data['pass'])
-
-            # Disconnect
-            self.logger.debug('Connected! Disconnecting...')
-            connect.Disconnect(service_instance)
+            # Connect, the session is kept for the deployers
+            self.connect()
+            self.logger.debug('Connected!')
 
             # We're good
             return True, []
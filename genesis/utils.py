@@ -1,18 +1,70 @@
+import ast
 import hashlib
+import operator
+import re
 import sys
+from functools import lru_cache
 
 
-def recursive_replace(node, replace_dict, num_iterations):
-    if isinstance(node, dict):
-        res = {}
-        for k, v in node.items():
-            res[k] = recursive_replace(v, replace_dict, num_iterations)
-
-        return res
-    elif isinstance(node, list):
-        return [recursive_replace(x, replace_dict, num_iterations) for x in node]
-    elif isinstance(node, str):
-        res = node
+class Template(object):
+    """
+    A pre-compiled form of a node (dict/list/str) containing "{variable}" placeholders.
+
+    Every string is split into literal and placeholder segments once, so rendering it
+    for a team is a single pass over the segments instead of a str.replace per variable.
+    """
+
+    PLACEHOLDER = re.compile(r'{([^{}]+)}')
+
+    def __init__(self, node):
+        self.compiled = self._compile(node)
+
+    def render(self, replace_dict, num_iterations):
+        values = self._resolve(replace_dict, num_iterations)
+
+        return self._render(self.compiled, values)
+
+    def _compile(self, node):
+        if isinstance(node, dict):
+            return _CompiledDict([(k, self._compile(v)) for k, v in node.items()])
+        elif isinstance(node, list):
+            return _CompiledList([self._compile(x) for x in node])
+        elif isinstance(node, str):
+            segments = []
+            pos = 0
+
+            for match in self.PLACEHOLDER.finditer(node):
+                if match.start() > pos:
+                    segments.append(node[pos:match.start()])
+
+                segments.append(_Placeholder(match.group(1), match.group(0)))
+                pos = match.end()
+
+            # Plain strings are stored as-is, as there is nothing to render
+            if not segments:
+                return node
+
+            if pos < len(node):
+                segments.append(node[pos:])
+
+            return _CompiledString(segments)
+
+        return node
+
+    def _render(self, node, values):
+        if isinstance(node, _CompiledDict):
+            return {k: self._render(v, values) for k, v in node}
+        elif isinstance(node, _CompiledList):
+            return [self._render(x, values) for x in node]
+        elif isinstance(node, _CompiledString):
+            return ''.join([values.get(x.name, x.raw) if isinstance(x, _Placeholder) else x for x in node])
+
+        return node
+
+    @staticmethod
+    def _resolve(replace_dict, num_iterations):
+        values = {}
+
         for k, v in replace_dict.items():
             value = v
 
@@ -24,21 +76,155 @@ def recursive_replace(node, replace_dict, num_iterations):
 
                 value = v[num_iterations]
 
-            res = res.replace("{{{}}}".format(k), str(value))
+            values[k] = str(value)
+
+        # Variables can reference each other (eg: net: "10.{octet}"), resolve them until nothing changes
+        for _ in range(len(values)):
+            changed = False
+
+            for k, v in values.items():
+                if '{' not in v:
+                    continue
+
+                resolved = Template.PLACEHOLDER.sub(lambda m: values.get(m.group(1), m.group(0)), v)
+                if resolved != v:
+                    values[k] = resolved
+                    changed = True
+
+            if not changed:
+                break
+
+        return values
+
+
+class _CompiledDict(list):
+    pass
+
+
+class _CompiledList(list):
+    pass
+
+
+class _CompiledString(list):
+    pass
+
+
+class _Placeholder(object):
+    __slots__ = ['name', 'raw']
+
+    def __init__(self, name, raw):
+        self.name = name
+        self.raw = raw
+
+
+def recursive_replace(node, replace_dict, num_iterations):
+    return Template(node).render(replace_dict, num_iterations)
+
+
+class Calculator(object):
+    """
+    A compiled "!calc" expression.
+
+    Only numbers, parentheses and the + - * / % operators are allowed. Placeholders
+    (eg: "{team}") are compiled into variables, so one expression can be evaluated
+    for every team without being parsed again.
+    """
+
+    BINARY_OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.Mod: operator.mod,
+    }
+
+    UNARY_OPERATORS = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+    }
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.variables = {}
+
+        source = Template.PLACEHOLDER.sub(self._compile_placeholder, expr)
+
+        try:
+            self.tree = ast.parse(source.strip(), mode='eval').body
+        except SyntaxError as exc:
+            raise Exception('Invalid !calc expression: {}'.format(expr)) from exc
+
+        self._check(self.tree)
+
+    def evaluate(self, variables=None):
+        values = {}
+        for name, placeholder in self.variables.items():
+            if variables is None or placeholder not in variables:
+                raise Exception('Unknown variable "{}" in !calc expression: {}'.format(placeholder, self.expr))
+
+            values[name] = self._number(variables[placeholder])
+
+        try:
+            return self._evaluate(self.tree, values)
+        except ZeroDivisionError as exc:
+            raise Exception('Invalid !calc expression (division by zero): {}'.format(self.expr)) from exc
+
+    def _compile_placeholder(self, match):
+        name = '_var{}'.format(len(self.variables))
+        self.variables[name] = match.group(1)
+
+        return name
+
+    def _check(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in self.BINARY_OPERATORS:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY_OPERATORS:
+            self._check(node.operand)
+        elif isinstance(node, ast.Name) and node.id in self.variables:
+            pass
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            pass
+        else:
+            raise Exception('Unsupported !calc expression: {}'.format(self.expr))
+
+    def _evaluate(self, node, values):
+        if isinstance(node, ast.BinOp):
+            return self.BINARY_OPERATORS[type(node.op)](self._evaluate(node.left, values),
+                                                        self._evaluate(node.right, values))
+        elif isinstance(node, ast.UnaryOp):
+            return self.UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, values))
+        elif isinstance(node, ast.Name):
+            return values[node.id]
+
+        return node.value
 
-        return res
+    def _number(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
 
-    return node
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
 
+        try:
+            return float(value)
+        except (TypeError, ValueError) as exc:
+            raise Exception('Variable value "{}" is not a number in !calc expression: {}'
+                            .format(value, self.expr)) from exc
 
-def calculator_eval(expr):
-    whitelist = '+*/%-'
-    if not any(char in whitelist or char.isdigit() for char in expr):
-        return 0
 
-    return eval(expr)  # pylint: disable=eval-used
+@lru_cache(maxsize=1024)
+def compile_calc(expr):
+    return Calculator(expr)
 
 
+def calculator_eval(expr, variables=None):
+    return compile_calc(expr).evaluate(variables)
+
+
+@lru_cache(maxsize=4096)
 def hashid(name):
     return hashlib.md5(name.encode('utf-8')).hexdigest()
 